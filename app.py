@@ -1,39 +1,281 @@
-from flask import Flask, render_template, request, redirect, session
+from flask import Flask, render_template, request, redirect, session, jsonify, Response, stream_with_context, g, has_request_context, abort
 import sqlite3
 import os
-from werkzeug.utils import secure_filename
-from datetime import datetime
+import re
+import hashlib
+import secrets
+import threading
+import click
+import time
+import csv
+import io
+import json
+import shutil
+import tempfile
+import tarfile
+import zipfile
+import gzip
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import quote
+from datetime import datetime, timedelta
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    # без Pillow картинки хранятся без уменьшенных копий
+    Image = None
+
+try:
+    import openpyxl
+except ImportError:
+    # без openpyxl импорт принимает только CSV
+    openpyxl = None
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: gunicorn там не работает, файлы метрик не сворачиваем
+    fcntl = None
+
+STARTUP_BEGIN = time.perf_counter()
 
 app = Flask(__name__)
 app.secret_key = "bratex_secret"
+# без уровня логгер Flask пропускает только warning и выше — под gunicorn
+# не было бы видно ни времени старта, ни отчётов обслуживания баз
+app.logger.setLevel(os.environ.get("BRATEX_LOG_LEVEL", "INFO").upper())
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-USERS_DB = os.path.join(BASE_DIR, "users.db")
+# базы можно держать отдельно от кода (бенчмарк, тестовые стенды)
+DATA_DIR = os.environ.get("BRATEX_DATA_DIR", BASE_DIR)
+os.makedirs(DATA_DIR, exist_ok=True)
+USERS_DB = os.path.join(DATA_DIR, "users.db")
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "static", "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 
+# ================== DB POOL ==================
+
+# сколько свободных соединений держим на один файл базы
+DB_POOL_PER_FILE = int(os.environ.get("BRATEX_DB_POOL_PER_FILE", "4"))
+# сколько файлов баз держим открытыми (остальные закрываются по LRU)
+DB_POOL_MAX_FILES = int(os.environ.get("BRATEX_DB_POOL_MAX_FILES", "64"))
+# файл, к которому процесс столько секунд не обращался, закрывается: открытая
+# база работника не даёт переименовать её при смене логина
+DB_POOL_IDLE_SECONDS = int(os.environ.get("BRATEX_DB_POOL_IDLE_SECONDS", "300"))
+
+DB_PRAGMAS = (
+    # действует только на новые файлы (до первой таблицы): освободившиеся
+    # страницы потом возвращает flask maintenance, без полного VACUUM
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-4000",
+    "PRAGMA mmap_size=67108864",
+    "PRAGMA temp_store=MEMORY",
+)
+DB_BUSY_TIMEOUT = 5.0
+
+
+class TimedCursor(sqlite3.Cursor):
+    # время и число запросов для /metrics; меряется execute — для SELECT это
+    # планирование и поиск первой строки, fetchall() сюда не входит
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            record_query(self.connection, sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            record_query(self.connection, sql, time.perf_counter() - start, batch=True)
+
+
+class PooledConnection(sqlite3.Connection):
+    # close() не закрывает файл, а возвращает соединение в пул,
+    # поэтому все роуты могут по-прежнему звать conn.close()
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    # conn.execute() у sqlite3 идёт мимо cursor(), поэтому тоже через TimedCursor
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def close(self):
+        DB_POOL.release(self)
+
+    def close_for_real(self):
+        sqlite3.Connection.close(self)
+
+
+class ConnectionPool:
+
+    def __init__(self, per_file, max_files, idle_seconds):
+        self.per_file = per_file
+        self.max_files = max_files
+        self.idle_seconds = idle_seconds
+        # свой лимит свободных соединений для отдельных файлов (общая база)
+        self.limits = {}
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()
+        self._used = {}
+        self._pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _check_fork(self):
+        # после fork (gunicorn --preload) соединения родителя не трогаем
+        if self._pid != os.getpid():
+            self._idle = OrderedDict()
+            self._used = {}
+            self._pid = os.getpid()
+
+    def _open(self, path):
+        conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT,
+                               factory=PooledConnection, check_same_thread=False)
+        conn.db_kind = db_kind(path)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        conn.pool_path = path
+        conn.tenant = None
+        conn.worker_names = None
+        return conn
+
+    def acquire(self, path, tenant=None):
+        with self._lock:
+            self._check_fork()
+            conns = self._idle.get(path)
+            if conns:
+                self._idle.move_to_end(path)
+                self.hits += 1
+                # в общей базе сначала ищем соединение, уже привязанное к работнику
+                index = -1
+                if tenant is not None:
+                    for i in range(len(conns) - 1, -1, -1):
+                        if conns[i].tenant == tenant:
+                            index = i
+                            break
+                conn = conns.pop(index)
+            else:
+                self.misses += 1
+                conn = None
+
+        if conn is None:
+            conn = self._open(path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+
+        to_close = []
+        with self._lock:
+            self._check_fork()
+            now = time.monotonic()
+            conns = self._idle.setdefault(conn.pool_path, [])
+            self._idle.move_to_end(conn.pool_path)
+            self._used[conn.pool_path] = now
+            if len(conns) < self.limits.get(conn.pool_path, self.per_file):
+                conns.append(conn)
+            else:
+                to_close.append(conn)
+
+            # _idle упорядочен по последнему использованию — старые файлы в начале
+            while len(self._idle) > self.max_files or \
+                    now - self._used[next(iter(self._idle))] > self.idle_seconds:
+                path, evicted = self._idle.popitem(last=False)
+                del self._used[path]
+                self.evictions += 1
+                to_close.extend(evicted)
+
+        for c in to_close:
+            c.close_for_real()
+
+    def pooled(self, path):
+        with self._lock:
+            return path in self._idle
+
+    def drop(self, path):
+        # закрыть все свободные соединения файла (удаление/переименование базы)
+        with self._lock:
+            conns = self._idle.pop(path, [])
+            self._used.pop(path, None)
+        for c in conns:
+            c.close_for_real()
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(v) for v in self._idle.values())
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "open_files": len(self._idle),
+                "idle_connections": idle,
+                "per_file": self.per_file,
+                "max_files": self.max_files,
+            }
+
+
+DB_POOL = ConnectionPool(DB_POOL_PER_FILE, DB_POOL_MAX_FILES, DB_POOL_IDLE_SECONDS)
+
+
 # ================== DB HELPERS ==================
 
+def worker_db_path(username):
+    return os.path.join(DATA_DIR, f"{username}.db")
+
+
 def get_users_db():
-    conn = sqlite3.connect(USERS_DB)
-    conn.row_factory = sqlite3.Row
+    conn = DB_POOL.acquire(USERS_DB)
+    if USERS_DB not in _ready_dbs:
+        init_users_db(conn)
     return conn
 
 
 def get_worker_db(username):
-    path = os.path.join(BASE_DIR, f"{username}.db")
-    conn = sqlite3.connect(path)
-    conn.row_factory = sqlite3.Row
+    if STORAGE == "shared":
+        return get_shared_db(username)
+
+    path = worker_db_path(username)
+    conn = DB_POOL.acquire(path)
+    if path not in _ready_dbs:
+        ensure_schema(conn, path, WORKER_MIGRATIONS)
     return conn
 
 
 # ================== INIT ==================
+# базы готовятся лениво, при первом обращении в процессе: старт воркера
+# не зависит от числа работников, а готовые файлы запоминаются здесь
+_ready_dbs = set()
 
-def init_users_db():
-    conn = get_users_db()
-    c = conn.cursor()
 
+def ensure_schema(conn, path, migrations):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < len(migrations):
+        run_migrations(conn, migrations)
+    _ready_dbs.add(path)
+
+
+def forget_db(path):
+    _ready_dbs.discard(path)
+    DB_POOL.drop(path)
+
+
+def _users_m1_tables(c):
     c.execute("""
     CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -51,23 +293,77 @@ def init_users_db():
     if "owner_admin" not in cols:
         c.execute("ALTER TABLE users ADD COLUMN owner_admin TEXT")
 
-    # главный админ всегда admin, пароль обновляется автоматически
-    c.execute("SELECT * FROM users WHERE username='admin'")
-    if not c.fetchone():
+
+def _users_m2_api_token(c):
+    # токен сканера храним как sha256 — сам токен знает только устройство
+    c.execute("ALTER TABLE users ADD COLUMN api_token TEXT")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_api_token ON users(api_token)")
+
+
+def _users_m3_maintenance(c):
+    # аренда фонового обслуживания (одна строка на все процессы) и когда
+    # какая база обслуживалась последний раз
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS maintenance_lease (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS maintenance_runs (
+        db_name TEXT PRIMARY KEY,
+        done_at TEXT NOT NULL,
+        ms REAL,
+        wal_kb INTEGER,
+        freed_pages INTEGER,
+        free_pages INTEGER
+    )
+    """)
+
+
+USERS_MIGRATIONS = [
+    _users_m1_tables,
+    _users_m2_api_token,
+    _users_m3_maintenance,
+]
+
+
+def init_users_db(conn):
+    ensure_schema(conn, USERS_DB, USERS_MIGRATIONS)
+
+    # главный админ всегда admin, пароль обновляется автоматически —
+    # но пишем в базу только если что-то действительно отличается
+    c = conn.cursor()
+    c.execute("SELECT password, type FROM users WHERE username='admin'")
+    row = c.fetchone()
+    if not row:
         c.execute("INSERT INTO users (username, password, type) VALUES (?, ?, ?)",
                   ("admin", "48444448r61222261r", "admin"))
-    else:
-        c.execute("UPDATE users SET password=? WHERE username='admin'", ("48444448r61222261r",))
-        c.execute("UPDATE users SET type='admin' WHERE username='admin'")
-
+    elif row["password"] != "48444448r61222261r" or row["type"] != "admin":
+        c.execute("UPDATE users SET password=?, type='admin' WHERE username='admin'",
+                  ("48444448r61222261r",))
     conn.commit()
-    conn.close()
 
 
-def init_worker_db(username):
-    conn = get_worker_db(username)
-    c = conn.cursor()
+def _fts5_available():
+    try:
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE VIRTUAL TABLE t USING fts5(x)")
+        conn.close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+FTS5_AVAILABLE = _fts5_available()
+
+
+# ================== MIGRATIONS ==================
+# версия схемы хранится в PRAGMA user_version каждого файла,
+# миграция N переводит базу с версии N-1 на N
 
+def _worker_m1_tables(c):
     c.execute("""
     CREATE TABLE IF NOT EXISTS products (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -94,646 +390,4690 @@ def init_worker_db(username):
     )
     """)
 
-    conn.commit()
-    conn.close()
-
-
-init_users_db()
 
-# создаём sales_history всем существующим работникам
-conn = get_users_db()
-c = conn.cursor()
-c.execute("SELECT username, password FROM users WHERE type='admin' AND username != 'admin'")
-users = c.fetchall()
-conn.close()
+def _worker_m2_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_barcode ON products(barcode)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_qr_code ON products(qr_code)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_category_size "
+              "ON products(category, size, height)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sales_time_product "
+              "ON sales_history(sale_time, product_id)")
+    c.execute("ANALYZE")
 
-for u in users:
-    init_worker_db(u["username"])
 
+def _worker_m3_fts(c):
+    if not FTS5_AVAILABLE:
+        return
 
-# ================== AUTH ==================
+    # внешний контент: индекс хранит только токены, строки берутся из products
+    c.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, description, barcode, qr_code,
+        content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """)
 
-@app.route("/", methods=["GET", "POST"])
-def login():
-    error = None
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name, description, barcode, qr_code)
+        VALUES (new.id, new.name, new.description, new.barcode, new.qr_code);
+    END
+    """)
 
-    if request.method == "POST":
-        username = request.form.get("login")
-        password = request.form.get("password")
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description, barcode, qr_code)
+        VALUES ('delete', old.id, old.name, old.description, old.barcode, old.qr_code);
+    END
+    """)
 
-        conn = get_users_db()
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE username=? AND password=?", (username, password))
-        user = c.fetchone()
-        conn.close()
+    # продажи меняют только quantity — индекс трогаем лишь при смене текстовых полей
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_au
+    AFTER UPDATE OF name, description, barcode, qr_code ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description, barcode, qr_code)
+        VALUES ('delete', old.id, old.name, old.description, old.barcode, old.qr_code);
+        INSERT INTO products_fts(rowid, name, description, barcode, qr_code)
+        VALUES (new.id, new.name, new.description, new.barcode, new.qr_code);
+    END
+    """)
 
-        if user:
-            session["user"] = username
-            session["type"] = user["type"]
-            if user["type"] == "admin":
-                return redirect("/admin_workers_panel")
-            else:
-                return redirect("/worker")
-        else:
-            error = "Неверный логин или пароль"
+    c.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
 
-    return render_template("login.html", error=error)
 
+def _worker_m4_category_index(c):
+    # (category, rowid) — постраничный вывод категории по id без сортировки
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_category ON products(category)")
 
-@app.route("/logout")
-def logout():
-    session.clear()
-    return redirect("/")
 
+def _worker_m5_data_version(c):
+    # счётчик изменений товаров: триггеры увеличивают его при любой записи,
+    # так кэши всех процессов gunicorn видят, что данные поменялись
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS data_version (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    c.execute("INSERT OR IGNORE INTO data_version (name, version) VALUES ('products', 0)")
 
-# ================== ADMIN ==================
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_version_{event.lower()}
+        AFTER {event} ON products BEGIN
+            UPDATE data_version SET version = version + 1 WHERE name='products';
+        END
+        """)
 
-@app.route("/admin")
-def admin_panel():
-    if session.get("type") != "admin":
-        return redirect("/")
 
-    conn = get_users_db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username != 'admin'")
-    users = c.fetchall()
-    conn.close()
+def rebuild_stock_by_size(c):
+    c.execute("DELETE FROM stock_by_size")
+    c.execute("""
+        INSERT INTO stock_by_size (category, size, height, quantity, items)
+        SELECT IFNULL(category, ''), IFNULL(size, ''), IFNULL(height, ''),
+               IFNULL(SUM(quantity), 0), COUNT(*)
+        FROM products
+        GROUP BY IFNULL(category, ''), IFNULL(size, ''), IFNULL(height, '')
+    """)
 
-    return render_template("admin_panel.html", users=users)
 
+def _worker_m6_stock_by_size(c):
+    # остатки по (категория, размер, рост) для таблицы размеров;
+    # items — сколько товаров в группе, строка удаляется, когда их не осталось
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS stock_by_size (
+        category TEXT NOT NULL,
+        size TEXT NOT NULL,
+        height TEXT NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        items INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (category, size, height)
+    ) WITHOUT ROWID
+    """)
 
-@app.route("/admin/create_user", methods=["POST"])
-def create_user():
-    if session.get("type") != "admin":
-        return redirect("/")
+    add_new = """
+        INSERT INTO stock_by_size (category, size, height, quantity, items)
+        VALUES (IFNULL(new.category, ''), IFNULL(new.size, ''), IFNULL(new.height, ''),
+                IFNULL(new.quantity, 0), 1)
+        ON CONFLICT (category, size, height) DO UPDATE
+        SET quantity = quantity + excluded.quantity, items = items + 1;
+    """
+    remove_old = """
+        UPDATE stock_by_size
+        SET quantity = quantity - IFNULL(old.quantity, 0), items = items - 1
+        WHERE category = IFNULL(old.category, '') AND size = IFNULL(old.size, '')
+          AND height = IFNULL(old.height, '');
+        DELETE FROM stock_by_size
+        WHERE category = IFNULL(old.category, '') AND size = IFNULL(old.size, '')
+          AND height = IFNULL(old.height, '') AND items <= 0;
+    """
+
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS stock_by_size_ai AFTER INSERT ON products BEGIN
+        {add_new}
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS stock_by_size_ad AFTER DELETE ON products BEGIN
+        {remove_old}
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS stock_by_size_au
+    AFTER UPDATE OF quantity, category, size, height ON products BEGIN
+        {remove_old}
+        {add_new}
+    END
+    """)
 
-    username = request.form.get("username")
-    password = request.form.get("password")
+    rebuild_stock_by_size(c)
 
-    conn = get_users_db()
-    c = conn.cursor()
-    c.execute("INSERT INTO users (username, password, type) VALUES (?, ?, ?)", (username, password, "worker"))
-    conn.commit()
-    conn.close()
 
-    init_worker_db(username)
+def rebuild_sales_rollups(c):
+    c.execute("DELETE FROM sales_daily")
+    c.execute("DELETE FROM sales_product_daily")
+    c.execute("DELETE FROM sales_product_total")
+    c.execute("""
+        INSERT INTO sales_daily (day, units, sales)
+        SELECT substr(sale_time, 1, 10), SUM(quantity), COUNT(*)
+        FROM sales_history GROUP BY substr(sale_time, 1, 10)
+    """)
+    c.execute("""
+        INSERT INTO sales_product_daily (day, product_id, units)
+        SELECT substr(sale_time, 1, 10), product_id, SUM(quantity)
+        FROM sales_history GROUP BY substr(sale_time, 1, 10), product_id
+    """)
+    c.execute("""
+        INSERT INTO sales_product_total (product_id, units, last_sale)
+        SELECT product_id, SUM(quantity), MAX(sale_time)
+        FROM sales_history GROUP BY product_id
+    """)
 
-    return redirect("/admin")
 
+def _worker_m7_sales_rollups(c):
+    # сводки продаж по дням и товарам; триггеры на sales_history
+    # обновляют их при каждой продаже и возврате
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sales_daily (
+        day TEXT PRIMARY KEY,
+        units INTEGER NOT NULL DEFAULT 0,
+        sales INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sales_product_daily (
+        day TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        units INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, product_id)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sales_product_total (
+        product_id INTEGER PRIMARY KEY,
+        units INTEGER NOT NULL DEFAULT 0,
+        last_sale TEXT
+    )
+    """)
 
-@app.route("/admin/user/<username>")
-def view_user(username):
-    if session.get("type") != "admin":
-        return redirect("/")
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS sales_rollup_ai AFTER INSERT ON sales_history BEGIN
+        INSERT INTO sales_daily (day, units, sales)
+        VALUES (substr(new.sale_time, 1, 10), new.quantity, 1)
+        ON CONFLICT (day) DO UPDATE
+        SET units = units + excluded.units, sales = sales + 1;
+
+        INSERT INTO sales_product_daily (day, product_id, units)
+        VALUES (substr(new.sale_time, 1, 10), new.product_id, new.quantity)
+        ON CONFLICT (day, product_id) DO UPDATE SET units = units + excluded.units;
+
+        INSERT INTO sales_product_total (product_id, units, last_sale)
+        VALUES (new.product_id, new.quantity, new.sale_time)
+        ON CONFLICT (product_id) DO UPDATE
+        SET units = units + excluded.units, last_sale = MAX(IFNULL(last_sale, ''), excluded.last_sale);
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS sales_rollup_ad AFTER DELETE ON sales_history BEGIN
+        UPDATE sales_daily SET units = units - old.quantity, sales = sales - 1
+        WHERE day = substr(old.sale_time, 1, 10);
+        UPDATE sales_product_daily SET units = units - old.quantity
+        WHERE day = substr(old.sale_time, 1, 10) AND product_id = old.product_id;
+        UPDATE sales_product_total SET units = units - old.quantity
+        WHERE product_id = old.product_id;
+    END
+    """)
+    # частичный возврат уменьшает quantity в строке продажи
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS sales_rollup_au AFTER UPDATE OF quantity ON sales_history BEGIN
+        UPDATE sales_daily SET units = units - old.quantity + new.quantity
+        WHERE day = substr(old.sale_time, 1, 10);
+        UPDATE sales_product_daily SET units = units - old.quantity + new.quantity
+        WHERE day = substr(old.sale_time, 1, 10) AND product_id = old.product_id;
+        UPDATE sales_product_total SET units = units - old.quantity + new.quantity
+        WHERE product_id = old.product_id;
+    END
+    """)
 
-    conn = get_users_db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username=?", (username,))
-    user = c.fetchone()
-    conn.close()
+    rebuild_sales_rollups(c)
 
-    return render_template("admin_user_card.html", user=user)
 
+def _worker_m8_sales_version(c):
+    # второй счётчик в data_version — для истории продаж (ETag страниц)
+    c.execute("INSERT OR IGNORE INTO data_version (name, version) VALUES ('sales', 0)")
 
-@app.route("/admin/user/<username>/<category>", methods=["GET", "POST"])
-def admin_user_products(username, category):
-    if session.get("type") != "admin":
-        return redirect("/")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS sales_version_{event.lower()}
+        AFTER {event} ON sales_history BEGIN
+            UPDATE data_version SET version = version + 1 WHERE name='sales';
+        END
+        """)
 
-    conn = get_worker_db(username)
-    c = conn.cursor()
 
-    search = request.args.get("search", "").strip()
+def take_stock_snapshot(c):
+    # снимок остатков всех товаров и номер последнего движения, вошедшего в него;
+    # вызывается внутри транзакции записи
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.execute("SELECT 1 FROM stock_snapshot_runs WHERE snapshot_at=?", (now,))
+    if c.fetchone():
+        return None
+    c.execute("SELECT IFNULL(MAX(id), 0) FROM stock_movements")
+    movement_id = c.fetchone()[0]
+    c.execute("INSERT INTO stock_snapshot_runs (snapshot_at, movement_id) VALUES (?, ?)", (now, movement_id))
+    c.execute("""
+        INSERT INTO stock_snapshots (snapshot_at, product_id, quantity)
+        SELECT ?, id, IFNULL(quantity, 0) FROM products
+    """, (now,))
+    return now
 
-    if request.method == "POST":
-        name = request.form.get("name")
-        description = request.form.get("description")
-        barcode = request.form.get("barcode")
-        qr_code = request.form.get("qr_code")
-        quantity = request.form.get("quantity")
-        size = request.form.get("size")
-        height = request.form.get("height")
 
-        image_file = request.files.get("image")
-        image_name = None
+def _worker_m9_stock_ledger(c):
+    # журнал движений остатка: только добавление строк. причину пишет код
+    # в movement_context на время своей транзакции (продажа, возврат, импорт),
+    # без неё триггер пишет create / edit / delete
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS stock_movements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        moved_at TEXT NOT NULL
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_movements_time ON stock_movements(moved_at)")
+    c.execute("CREATE TABLE IF NOT EXISTS movement_context (reason TEXT NOT NULL)")
 
-        if image_file and image_file.filename:
-            image_name = secure_filename(image_file.filename)
-            image_file.save(os.path.join(UPLOAD_FOLDER, image_name))
+    # снимки: остаток на момент snapshot_at = все движения с id <= movement_id
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS stock_snapshot_runs (
+        snapshot_at TEXT PRIMARY KEY,
+        movement_id INTEGER NOT NULL
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS stock_snapshots (
+        snapshot_at TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (snapshot_at, product_id)
+    ) WITHOUT ROWID
+    """)
 
-        c.execute("""
-            INSERT INTO products (name, description, barcode, qr_code, quantity, image, category, size, height)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (name, description, barcode, qr_code, quantity, image_name, category, size, height))
-        conn.commit()
+    now = "strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')"
+    reason = "IFNULL((SELECT reason FROM movement_context LIMIT 1), '{}')"
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS stock_movements_ai AFTER INSERT ON products
+    WHEN IFNULL(new.quantity, 0) != 0 BEGIN
+        INSERT INTO stock_movements (product_id, delta, reason, moved_at)
+        VALUES (new.id, new.quantity, {reason.format('create')}, {now});
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS stock_movements_au AFTER UPDATE OF quantity ON products
+    WHEN IFNULL(new.quantity, 0) != IFNULL(old.quantity, 0) BEGIN
+        INSERT INTO stock_movements (product_id, delta, reason, moved_at)
+        VALUES (new.id, IFNULL(new.quantity, 0) - IFNULL(old.quantity, 0), {reason.format('edit')}, {now});
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS stock_movements_ad AFTER DELETE ON products
+    WHEN IFNULL(old.quantity, 0) != 0 BEGIN
+        INSERT INTO stock_movements (product_id, delta, reason, moved_at)
+        VALUES (old.id, -IFNULL(old.quantity, 0), 'delete', {now});
+    END
+    """)
 
-    if search:
-        c.execute("""
-            SELECT * FROM products
-            WHERE category=? AND (name LIKE ? OR barcode LIKE ? OR qr_code LIKE ?)
-        """, (category, f"%{search}%", f"%{search}%", f"%{search}%"))
-    else:
-        c.execute("SELECT * FROM products WHERE category=?", (category,))
+    # журнал начинается с текущих остатков
+    c.execute(f"""
+        INSERT INTO stock_movements (product_id, delta, reason, moved_at)
+        SELECT id, quantity, 'initial', {now} FROM products WHERE IFNULL(quantity, 0) != 0
+    """)
+    take_stock_snapshot(c)
 
-    products = c.fetchall()
-    conn.close()
 
-    return render_template(
-        "products_list.html",
-        products=products,
-        category=category,
-        user=username,
-        is_admin=True,
-        search=search
+def rebuild_stock_reorder(c):
+    today, since = reorder_window()
+    c.execute("DELETE FROM stock_reorder")
+    c.execute("""
+        INSERT INTO stock_reorder (product_id, category, quantity, sold, reorder_point, low, window_day)
+        SELECT id, category, IFNULL(quantity, 0),
+               IFNULL((SELECT SUM(units) FROM sales_product_daily d
+                       WHERE d.product_id = products.id AND d.day > ?), 0), 0, 0, ?
+        FROM products
+    """, (since, today))
+    point = reorder_point_sql("sold")
+    c.execute(f"UPDATE stock_reorder SET reorder_point = {point}, low = quantity <= {point}")
+
+
+def _worker_m10_reorder(c):
+    # точки заказа: продажи товара за окно копят триггеры сводки по дням,
+    # остаток — триггеры товаров; список «заканчивается» читается по индексу
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS stock_reorder (
+        product_id INTEGER PRIMARY KEY,
+        category TEXT,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        sold INTEGER NOT NULL DEFAULT 0,
+        reorder_point INTEGER NOT NULL DEFAULT 0,
+        low INTEGER NOT NULL DEFAULT 0,
+        window_day TEXT NOT NULL
     )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_reorder_low ON stock_reorder(low, category)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_reorder_window ON stock_reorder(window_day)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sales_product_daily_product "
+              "ON sales_product_daily(product_id, day)")
+
+    today = "date('now', 'localtime')"
+    window = f"date('now', 'localtime', '-{REORDER_WINDOW_DAYS} days')"
+    point = reorder_point_sql("new.sold")
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS stock_reorder_ai AFTER INSERT ON products BEGIN
+        INSERT INTO stock_reorder (product_id, category, quantity, low, window_day)
+        VALUES (new.id, new.category, IFNULL(new.quantity, 0), IFNULL(new.quantity, 0) <= 0, {today});
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS stock_reorder_au AFTER UPDATE OF quantity, category ON products BEGIN
+        UPDATE stock_reorder SET quantity = IFNULL(new.quantity, 0), category = new.category
+        WHERE product_id = new.id;
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS stock_reorder_ad AFTER DELETE ON products BEGIN
+        DELETE FROM stock_reorder WHERE product_id = old.id;
+    END
+    """)
+    # продажа добавляет units, возврат уменьшает — учитываем только дни внутри окна
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS stock_reorder_sales_ai AFTER INSERT ON sales_product_daily
+    WHEN new.day > {window} BEGIN
+        UPDATE stock_reorder SET sold = sold + new.units WHERE product_id = new.product_id;
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS stock_reorder_sales_au AFTER UPDATE OF units ON sales_product_daily
+    WHEN new.day > {window} BEGIN
+        UPDATE stock_reorder SET sold = sold + new.units - old.units WHERE product_id = new.product_id;
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS stock_reorder_point AFTER UPDATE OF sold, quantity ON stock_reorder BEGIN
+        UPDATE stock_reorder SET reorder_point = {point}, low = new.quantity <= {point}
+        WHERE product_id = new.product_id;
+    END
+    """)
 
-
-# ================== WORKER MENU ==================
-
-@app.route("/worker")
-def worker_menu():
-    if "user" not in session or session.get("type") != "worker":
-        return redirect("/")
-
-    return render_template("worker_menu.html", username=session["user"])
+    rebuild_stock_reorder(c)
 
 
-@app.route("/worker/warehouse")
-def worker_warehouse_menu():
-    if "user" not in session or session.get("type") != "worker":
-        return redirect("/")
+def _worker_m11_codes_version(c):
+    # счётчик для кэша кодов: растёт, только когда код может начать указывать
+    # на другой товар — продажи меняют quantity и его не трогают
+    c.execute("INSERT OR IGNORE INTO data_version (name, version) VALUES ('codes', 0)")
 
-    return render_template("warehouse_menu.html", username=session["user"])
+    changed = "WHEN old.barcode IS NOT new.barcode OR old.qr_code IS NOT new.qr_code"
+    for name, event, when in (("insert", "INSERT", ""),
+                              ("update", "UPDATE OF barcode, qr_code", changed),
+                              ("delete", "DELETE", "")):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS codes_version_{name}
+        AFTER {event} ON products {when} BEGIN
+            UPDATE data_version SET version = version + 1 WHERE name='codes';
+        END
+        """)
 
 
-# ================== WORKER PRODUCTS ==================
+def _worker_m12_import_fts(c):
+    # импорт дописывает FTS одной вставкой на пачку — построчный триггер
+    # на это время молчит: иначе он занимает половину времени импорта
+    c.execute("SELECT 1 FROM sqlite_master WHERE name='products_fts'")
+    if not c.fetchone():
+        return
+    c.execute("DROP TRIGGER IF EXISTS products_fts_ai")
+    c.execute("""
+    CREATE TRIGGER products_fts_ai AFTER INSERT ON products
+    WHEN NOT EXISTS (SELECT 1 FROM movement_context WHERE reason = 'import') BEGIN
+        INSERT INTO products_fts(rowid, name, description, barcode, qr_code)
+        VALUES (new.id, new.name, new.description, new.barcode, new.qr_code);
+    END
+    """)
 
-@app.route("/worker/<category>", methods=["GET", "POST"])
-def worker_products(category):
-    if "user" not in session or session.get("type") != "worker":
-        return redirect("/")
 
-    username = session["user"]
-    conn = get_worker_db(username)
+def _worker_m13_drop_codes_version(c):
+    # кэш кодов снова сверяется со счётчиком 'products' — 'codes' не нужен
+    for name in ("insert", "update", "delete"):
+        c.execute(f"DROP TRIGGER IF EXISTS codes_version_{name}")
+    c.execute("DELETE FROM data_version WHERE name='codes'")
+
+
+WORKER_MIGRATIONS = [
+    _worker_m1_tables,
+    _worker_m2_indexes,
+    _worker_m3_fts,
+    _worker_m4_category_index,
+    _worker_m5_data_version,
+    _worker_m6_stock_by_size,
+    _worker_m7_sales_rollups,
+    _worker_m8_sales_version,
+    _worker_m9_stock_ledger,
+    _worker_m10_reorder,
+    _worker_m11_codes_version,
+    _worker_m12_import_fts,
+    _worker_m13_drop_codes_version,
+]
+WORKER_SCHEMA_VERSION = len(WORKER_MIGRATIONS)
+
+
+def run_migrations(conn, migrations):
     c = conn.cursor()
+    start = c.execute("PRAGMA user_version").fetchone()[0]
+
+    while True:
+        c.execute("BEGIN IMMEDIATE")
+        # перечитываем версию под блокировкой: другой воркер мог успеть раньше
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(migrations):
+            conn.rollback()
+            break
+        migrations[version](c)
+        c.execute(f"PRAGMA user_version={version + 1}")
+        conn.commit()
 
-    search = request.args.get("search", "").strip()
-
-    if request.method == "POST":
-        name = request.form.get("name")
-        description = request.form.get("description")
-        barcode = request.form.get("barcode")
-        qr_code = request.form.get("qr_code")
-        quantity = request.form.get("quantity")
-        size = request.form.get("size")
-        height = request.form.get("height")
-
-        image_file = request.files.get("image")
-        image_name = None
-
-        if image_file and image_file.filename:
-            image_name = secure_filename(image_file.filename)
-            image_file.save(os.path.join(UPLOAD_FOLDER, image_name))
+    return start, c.execute("PRAGMA user_version").fetchone()[0]
 
-        c.execute("""
-            INSERT INTO products (name, description, barcode, qr_code, quantity, image, category, size, height)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (name, description, barcode, qr_code, quantity, image_name, category, size, height))
-        conn.commit()
 
-    if search:
-        c.execute("""
-            SELECT * FROM products
-            WHERE category=? AND (name LIKE ? OR barcode LIKE ? OR qr_code LIKE ?)
-        """, (category, f"%{search}%", f"%{search}%", f"%{search}%"))
-    else:
-        c.execute("SELECT * FROM products WHERE category=?", (category,))
+def tenant_files():
+    # базы работников лежат рядом с users.db как <username>.db
+    names = []
+    for fname in sorted(os.listdir(DATA_DIR)):
+        path = os.path.join(DATA_DIR, fname)
+        if fname.endswith(".db") and path not in (USERS_DB, SHARED_DB):
+            names.append(fname[:-3])
+    return names
 
-    products = c.fetchall()
-    conn.close()
 
-    return render_template(
-        "products_list.html",
-        products=products,
-        category=category,
-        user=username,
-        is_admin=False,
-        search=search
-    )
+def tenant_usernames():
+    if STORAGE == "shared":
+        conn = get_users_db()
+        c = conn.cursor()
+        c.execute("SELECT username FROM users WHERE type='worker' ORDER BY username")
+        names = [r["username"] for r in c.fetchall()]
+        conn.close()
+        return names
+    return tenant_files()
 
 
-# ================== EDIT PRODUCT ==================
+def tenant_exists(username):
+    if STORAGE == "shared":
+        # в общей базе файла нет — работник существует, если он есть в users
+        conn = get_users_db()
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM users WHERE username=? AND type='worker'", (username,))
+        found = c.fetchone() is not None
+        conn.close()
+        return found
+    return os.path.exists(worker_db_path(username))
 
-@app.route("/product/<username>/<int:product_id>")
-def view_product(username, product_id):
-    if "user" not in session:
-        return redirect("/")
 
-    conn = get_worker_db(username)
+def init_worker_db(username):
+    get_worker_db(username).close()
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Накатить миграции на все базы работников."""
+    if STORAGE == "shared":
+        conn = DB_POOL.acquire(SHARED_DB)
+        try:
+            before, after = run_migrations(conn, SHARED_MIGRATIONS)
+        finally:
+            conn.close()
+        print(f"shared: {before} -> {after}")
+        return
+
+    for username in tenant_files():
+        conn = DB_POOL.acquire(worker_db_path(username))
+        try:
+            before, after = run_migrations(conn, WORKER_MIGRATIONS)
+        finally:
+            conn.close()
+        print(f"{username}: {before} -> {after}")
+
+
+# ================== STORAGE ==================
+# BRATEX_STORAGE=files (по умолчанию) — своя база <username>.db у каждого работника.
+# BRATEX_STORAGE=shared — все работники в одной tenants.db, строки помечены tenant_id.
+# В общей базе каждое соединение привязано к одному работнику: временные
+# представления products, sales_history, ... показывают только его строки,
+# поэтому SQL в роутах одинаков для обоих вариантов.
+
+STORAGE = os.environ.get("BRATEX_STORAGE", "files")
+SHARED_DB = os.path.join(DATA_DIR, "tenants.db")
+DB_POOL.limits[SHARED_DB] = int(os.environ.get("BRATEX_SHARED_POOL_SIZE", "16"))
+
+# представление -> (ключ, колонки); в общей базе таблица называется tenant_<имя>
+SHARED_VIEWS = {
+    "products": (("id",), ("id", "name", "description", "barcode", "qr_code", "quantity",
+                           "image", "category", "size", "height")),
+    "sales_history": (("id",), ("id", "product_id", "name", "barcode", "quantity", "sale_time")),
+    "stock_by_size": (("category", "size", "height"), ("category", "size", "height", "quantity", "items")),
+    "data_version": (("name",), ("name", "version")),
+    "sales_daily": (("day",), ("day", "units", "sales")),
+    "sales_product_daily": (("day", "product_id"), ("day", "product_id", "units")),
+    "sales_product_total": (("product_id",), ("product_id", "units", "last_sale")),
+    "stock_movements": (("id",), ("id", "product_id", "delta", "reason", "moved_at")),
+    "movement_context": (("reason",), ("reason",)),
+    "stock_snapshot_runs": (("snapshot_at",), ("snapshot_at", "movement_id")),
+    "stock_snapshots": (("snapshot_at", "product_id"), ("snapshot_at", "product_id", "quantity")),
+    "stock_reorder": (("product_id",), ("product_id", "category", "quantity", "sold",
+                                        "reorder_point", "low", "window_day")),
+}
+
+
+def _shared_m1_schema(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tenant_id TEXT NOT NULL,
+        name TEXT,
+        description TEXT,
+        barcode TEXT,
+        qr_code TEXT,
+        quantity INTEGER,
+        image TEXT,
+        category TEXT,
+        size TEXT,
+        height TEXT
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_sales_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tenant_id TEXT NOT NULL,
+        product_id INTEGER,
+        name TEXT,
+        barcode TEXT,
+        quantity INTEGER,
+        sale_time TEXT
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_stock_by_size (
+        tenant_id TEXT NOT NULL,
+        category TEXT NOT NULL,
+        size TEXT NOT NULL,
+        height TEXT NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        items INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (tenant_id, category, size, height)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_data_version (
+        tenant_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (tenant_id, name)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_sales_daily (
+        tenant_id TEXT NOT NULL,
+        day TEXT NOT NULL,
+        units INTEGER NOT NULL DEFAULT 0,
+        sales INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (tenant_id, day)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_sales_product_daily (
+        tenant_id TEXT NOT NULL,
+        day TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        units INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (tenant_id, day, product_id)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_sales_product_total (
+        tenant_id TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        units INTEGER NOT NULL DEFAULT 0,
+        last_sale TEXT,
+        PRIMARY KEY (tenant_id, product_id)
+    ) WITHOUT ROWID
+    """)
+
+    # составные индексы: tenant_id всегда первым, дальше — как в базе работника
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tp_tenant ON tenant_products(tenant_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tp_barcode ON tenant_products(tenant_id, barcode)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tp_qr_code ON tenant_products(tenant_id, qr_code)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tp_category ON tenant_products(tenant_id, category)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tp_category_size "
+              "ON tenant_products(tenant_id, category, size, height)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ts_tenant ON tenant_sales_history(tenant_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ts_time_product "
+              "ON tenant_sales_history(tenant_id, sale_time, product_id)")
+
+    if FTS5_AVAILABLE:
+        c.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description, barcode, qr_code,
+            content='tenant_products', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+        """)
+        c.execute("""
+        CREATE TRIGGER IF NOT EXISTS shared_fts_ai AFTER INSERT ON tenant_products BEGIN
+            INSERT INTO products_fts(rowid, name, description, barcode, qr_code)
+            VALUES (new.id, new.name, new.description, new.barcode, new.qr_code);
+        END
+        """)
+        c.execute("""
+        CREATE TRIGGER IF NOT EXISTS shared_fts_ad AFTER DELETE ON tenant_products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, name, description, barcode, qr_code)
+            VALUES ('delete', old.id, old.name, old.description, old.barcode, old.qr_code);
+        END
+        """)
+        # обновление через представление переписывает все колонки — сравниваем значения
+        c.execute("""
+        CREATE TRIGGER IF NOT EXISTS shared_fts_au AFTER UPDATE ON tenant_products
+        WHEN old.name IS NOT new.name OR old.description IS NOT new.description
+          OR old.barcode IS NOT new.barcode OR old.qr_code IS NOT new.qr_code BEGIN
+            INSERT INTO products_fts(products_fts, rowid, name, description, barcode, qr_code)
+            VALUES ('delete', old.id, old.name, old.description, old.barcode, old.qr_code);
+            INSERT INTO products_fts(rowid, name, description, barcode, qr_code)
+            VALUES (new.id, new.name, new.description, new.barcode, new.qr_code);
+        END
+        """)
+
+    for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS shared_version_{event.lower()}
+        AFTER {event} ON tenant_products BEGIN
+            INSERT INTO tenant_data_version (tenant_id, name, version)
+            VALUES ({row}.tenant_id, 'products', 1)
+            ON CONFLICT (tenant_id, name) DO UPDATE SET version = version + 1;
+        END
+        """)
+
+    add_new = """
+        INSERT INTO tenant_stock_by_size (tenant_id, category, size, height, quantity, items)
+        VALUES (new.tenant_id, IFNULL(new.category, ''), IFNULL(new.size, ''), IFNULL(new.height, ''),
+                IFNULL(new.quantity, 0), 1)
+        ON CONFLICT (tenant_id, category, size, height) DO UPDATE
+        SET quantity = quantity + excluded.quantity, items = items + 1;
+    """
+    remove_old = """
+        UPDATE tenant_stock_by_size
+        SET quantity = quantity - IFNULL(old.quantity, 0), items = items - 1
+        WHERE tenant_id = old.tenant_id AND category = IFNULL(old.category, '')
+          AND size = IFNULL(old.size, '') AND height = IFNULL(old.height, '');
+        DELETE FROM tenant_stock_by_size
+        WHERE tenant_id = old.tenant_id AND category = IFNULL(old.category, '')
+          AND size = IFNULL(old.size, '') AND height = IFNULL(old.height, '') AND items <= 0;
+    """
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS shared_stock_ai AFTER INSERT ON tenant_products BEGIN
+        {add_new}
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS shared_stock_ad AFTER DELETE ON tenant_products BEGIN
+        {remove_old}
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS shared_stock_au AFTER UPDATE ON tenant_products
+    WHEN old.quantity IS NOT new.quantity OR old.category IS NOT new.category
+      OR old.size IS NOT new.size OR old.height IS NOT new.height
+      OR old.tenant_id IS NOT new.tenant_id BEGIN
+        {remove_old}
+        {add_new}
+    END
+    """)
+
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS shared_rollup_ai AFTER INSERT ON tenant_sales_history BEGIN
+        INSERT INTO tenant_sales_daily (tenant_id, day, units, sales)
+        VALUES (new.tenant_id, substr(new.sale_time, 1, 10), new.quantity, 1)
+        ON CONFLICT (tenant_id, day) DO UPDATE
+        SET units = units + excluded.units, sales = sales + 1;
+
+        INSERT INTO tenant_sales_product_daily (tenant_id, day, product_id, units)
+        VALUES (new.tenant_id, substr(new.sale_time, 1, 10), new.product_id, new.quantity)
+        ON CONFLICT (tenant_id, day, product_id) DO UPDATE SET units = units + excluded.units;
+
+        INSERT INTO tenant_sales_product_total (tenant_id, product_id, units, last_sale)
+        VALUES (new.tenant_id, new.product_id, new.quantity, new.sale_time)
+        ON CONFLICT (tenant_id, product_id) DO UPDATE
+        SET units = units + excluded.units, last_sale = MAX(IFNULL(last_sale, ''), excluded.last_sale);
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS shared_rollup_ad AFTER DELETE ON tenant_sales_history BEGIN
+        UPDATE tenant_sales_daily SET units = units - old.quantity, sales = sales - 1
+        WHERE tenant_id = old.tenant_id AND day = substr(old.sale_time, 1, 10);
+        UPDATE tenant_sales_product_daily SET units = units - old.quantity
+        WHERE tenant_id = old.tenant_id AND day = substr(old.sale_time, 1, 10)
+          AND product_id = old.product_id;
+        UPDATE tenant_sales_product_total SET units = units - old.quantity
+        WHERE tenant_id = old.tenant_id AND product_id = old.product_id;
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS shared_rollup_au AFTER UPDATE OF quantity ON tenant_sales_history
+    WHEN old.quantity IS NOT new.quantity BEGIN
+        UPDATE tenant_sales_daily SET units = units - old.quantity + new.quantity
+        WHERE tenant_id = old.tenant_id AND day = substr(old.sale_time, 1, 10);
+        UPDATE tenant_sales_product_daily SET units = units - old.quantity + new.quantity
+        WHERE tenant_id = old.tenant_id AND day = substr(old.sale_time, 1, 10)
+          AND product_id = old.product_id;
+        UPDATE tenant_sales_product_total SET units = units - old.quantity + new.quantity
+        WHERE tenant_id = old.tenant_id AND product_id = old.product_id;
+    END
+    """)
+
+
+def _shared_m2_sales_version(c):
+    for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS shared_sales_version_{event.lower()}
+        AFTER {event} ON tenant_sales_history BEGIN
+            INSERT INTO tenant_data_version (tenant_id, name, version)
+            VALUES ({row}.tenant_id, 'sales', 1)
+            ON CONFLICT (tenant_id, name) DO UPDATE SET version = version + 1;
+        END
+        """)
+
+
+def _shared_m3_stock_ledger(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_stock_movements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tenant_id TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        moved_at TEXT NOT NULL
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tm_time ON tenant_stock_movements(tenant_id, moved_at)")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_movement_context (
+        tenant_id TEXT NOT NULL,
+        reason TEXT NOT NULL
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_stock_snapshot_runs (
+        tenant_id TEXT NOT NULL,
+        snapshot_at TEXT NOT NULL,
+        movement_id INTEGER NOT NULL,
+        PRIMARY KEY (tenant_id, snapshot_at)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_stock_snapshots (
+        tenant_id TEXT NOT NULL,
+        snapshot_at TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (tenant_id, snapshot_at, product_id)
+    ) WITHOUT ROWID
+    """)
+
+    now = "strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')"
+    reason = ("IFNULL((SELECT reason FROM tenant_movement_context "
+              "WHERE tenant_id = {row}.tenant_id LIMIT 1), '{default}')")
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS shared_movements_ai AFTER INSERT ON tenant_products
+    WHEN IFNULL(new.quantity, 0) != 0 BEGIN
+        INSERT INTO tenant_stock_movements (tenant_id, product_id, delta, reason, moved_at)
+        VALUES (new.tenant_id, new.id, new.quantity, {reason.format(row='new', default='create')}, {now});
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS shared_movements_au AFTER UPDATE OF quantity ON tenant_products
+    WHEN IFNULL(new.quantity, 0) != IFNULL(old.quantity, 0) BEGIN
+        INSERT INTO tenant_stock_movements (tenant_id, product_id, delta, reason, moved_at)
+        VALUES (new.tenant_id, new.id, IFNULL(new.quantity, 0) - IFNULL(old.quantity, 0),
+                {reason.format(row='new', default='edit')}, {now});
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS shared_movements_ad AFTER DELETE ON tenant_products
+    WHEN IFNULL(old.quantity, 0) != 0 BEGIN
+        INSERT INTO tenant_stock_movements (tenant_id, product_id, delta, reason, moved_at)
+        VALUES (old.tenant_id, old.id, -IFNULL(old.quantity, 0), 'delete', {now});
+    END
+    """)
+
+    c.execute(f"""
+        INSERT INTO tenant_stock_movements (tenant_id, product_id, delta, reason, moved_at)
+        SELECT tenant_id, id, quantity, 'initial', {now} FROM tenant_products
+        WHERE IFNULL(quantity, 0) != 0
+    """)
+
+
+def _shared_m4_reorder(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_stock_reorder (
+        tenant_id TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        category TEXT,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        sold INTEGER NOT NULL DEFAULT 0,
+        reorder_point INTEGER NOT NULL DEFAULT 0,
+        low INTEGER NOT NULL DEFAULT 0,
+        window_day TEXT NOT NULL,
+        PRIMARY KEY (tenant_id, product_id)
+    ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tr_low ON tenant_stock_reorder(tenant_id, low, category)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tr_window ON tenant_stock_reorder(tenant_id, window_day)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tspd_product "
+              "ON tenant_sales_product_daily(tenant_id, product_id, day)")
+
+    today = "date('now', 'localtime')"
+    window = f"date('now', 'localtime', '-{REORDER_WINDOW_DAYS} days')"
+    point = reorder_point_sql("new.sold")
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS shared_reorder_ai AFTER INSERT ON tenant_products BEGIN
+        INSERT INTO tenant_stock_reorder (tenant_id, product_id, category, quantity, low, window_day)
+        VALUES (new.tenant_id, new.id, new.category, IFNULL(new.quantity, 0),
+                IFNULL(new.quantity, 0) <= 0, {today});
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS shared_reorder_au AFTER UPDATE OF quantity, category ON tenant_products BEGIN
+        UPDATE tenant_stock_reorder SET quantity = IFNULL(new.quantity, 0), category = new.category
+        WHERE tenant_id = new.tenant_id AND product_id = new.id;
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS shared_reorder_ad AFTER DELETE ON tenant_products BEGIN
+        DELETE FROM tenant_stock_reorder WHERE tenant_id = old.tenant_id AND product_id = old.id;
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS shared_reorder_sales_ai AFTER INSERT ON tenant_sales_product_daily
+    WHEN new.day > {window} BEGIN
+        UPDATE tenant_stock_reorder SET sold = sold + new.units
+        WHERE tenant_id = new.tenant_id AND product_id = new.product_id;
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS shared_reorder_sales_au AFTER UPDATE OF units ON tenant_sales_product_daily
+    WHEN new.day > {window} BEGIN
+        UPDATE tenant_stock_reorder SET sold = sold + new.units - old.units
+        WHERE tenant_id = new.tenant_id AND product_id = new.product_id;
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS shared_reorder_point AFTER UPDATE OF sold, quantity ON tenant_stock_reorder BEGIN
+        UPDATE tenant_stock_reorder SET reorder_point = {point}, low = new.quantity <= {point}
+        WHERE tenant_id = new.tenant_id AND product_id = new.product_id;
+    END
+    """)
+
+    today, since = reorder_window()
+    c.execute("""
+        INSERT INTO tenant_stock_reorder (tenant_id, product_id, category, quantity, sold, window_day)
+        SELECT tenant_id, id, category, IFNULL(quantity, 0),
+               IFNULL((SELECT SUM(units) FROM tenant_sales_product_daily d
+                       WHERE d.tenant_id = p.tenant_id AND d.product_id = p.id AND d.day > ?), 0), ?
+        FROM tenant_products p
+    """, (since, today))
+    point = reorder_point_sql("sold")
+    c.execute(f"UPDATE tenant_stock_reorder SET reorder_point = {point}, low = quantity <= {point}")
+
+
+def _shared_m5_codes_version(c):
+    # представление обновляет все колонки сразу — сравниваем коды явно
+    changed = ("WHEN old.barcode IS NOT new.barcode OR old.qr_code IS NOT new.qr_code "
+               "OR old.tenant_id IS NOT new.tenant_id")
+    for event, row, when in (("INSERT", "new", ""), ("UPDATE", "new", changed), ("DELETE", "old", "")):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS shared_codes_version_{event.lower()}
+        AFTER {event} ON tenant_products {when} BEGIN
+            INSERT INTO tenant_data_version (tenant_id, name, version)
+            VALUES ({row}.tenant_id, 'codes', 1)
+            ON CONFLICT (tenant_id, name) DO UPDATE SET version = version + 1;
+        END
+        """)
+
+
+def _shared_m6_import_fts(c):
+    # то же, что _worker_m12_import_fts
+    c.execute("SELECT 1 FROM sqlite_master WHERE name='products_fts'")
+    if not c.fetchone():
+        return
+    c.execute("DROP TRIGGER IF EXISTS shared_fts_ai")
+    c.execute("""
+    CREATE TRIGGER shared_fts_ai AFTER INSERT ON tenant_products
+    WHEN NOT EXISTS (SELECT 1 FROM tenant_movement_context
+                     WHERE tenant_id = new.tenant_id AND reason = 'import') BEGIN
+        INSERT INTO products_fts(rowid, name, description, barcode, qr_code)
+        VALUES (new.id, new.name, new.description, new.barcode, new.qr_code);
+    END
+    """)
+
+
+def _shared_m7_drop_codes_version(c):
+    for event in ("insert", "update", "delete"):
+        c.execute(f"DROP TRIGGER IF EXISTS shared_codes_version_{event}")
+    c.execute("DELETE FROM tenant_data_version WHERE name='codes'")
+
+
+SHARED_MIGRATIONS = [
+    _shared_m1_schema,
+    _shared_m2_sales_version,
+    _shared_m3_stock_ledger,
+    _shared_m4_reorder,
+    _shared_m5_codes_version,
+    _shared_m6_import_fts,
+    _shared_m7_drop_codes_version,
+]
+
+
+def bind_tenant(conn, username):
+    # временные представления создаются один раз на соединение и берут работника
+    # из temp.current_tenant — смена работника это один UPDATE, без DDL
+    c = conn.cursor()
+    c.execute("BEGIN")
+    if conn.tenant is None:
+        tenant = "(SELECT tenant_id FROM temp.current_tenant)"
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS current_tenant (tenant_id TEXT NOT NULL)")
+        c.execute("INSERT INTO temp.current_tenant (tenant_id) VALUES ('')")
+        for name, (keys, cols) in SHARED_VIEWS.items():
+            values = ", ".join(f"new.{col}" for col in cols)
+            match = " AND ".join(f"{key} = old.{key}" for key in keys)
+            assign = ", ".join(f"{col} = new.{col}" for col in cols if col not in keys)
+
+            c.execute(f"""
+                CREATE TEMP VIEW {name} AS
+                SELECT {", ".join(cols)} FROM tenant_{name} WHERE tenant_id = {tenant}
+            """)
+            c.execute(f"""
+                CREATE TEMP TRIGGER {name}_insert INSTEAD OF INSERT ON {name} BEGIN
+                    INSERT INTO tenant_{name} (tenant_id, {", ".join(cols)}) VALUES ({tenant}, {values});
+                END
+            """)
+            # у таблиц из одних ключей обновлять нечего
+            if assign:
+                c.execute(f"""
+                    CREATE TEMP TRIGGER {name}_update INSTEAD OF UPDATE ON {name} BEGIN
+                        UPDATE tenant_{name} SET {assign} WHERE tenant_id = {tenant} AND {match};
+                    END
+                """)
+            c.execute(f"""
+                CREATE TEMP TRIGGER {name}_delete INSTEAD OF DELETE ON {name} BEGIN
+                    DELETE FROM tenant_{name} WHERE tenant_id = {tenant} AND {match};
+                END
+            """)
+    c.execute("UPDATE temp.current_tenant SET tenant_id = ?", (username,))
+    conn.commit()
+    conn.tenant = username
+
+
+def get_shared_db(username):
+    conn = DB_POOL.acquire(SHARED_DB, tenant=username)
+    if SHARED_DB not in _ready_dbs:
+        ensure_schema(conn, SHARED_DB, SHARED_MIGRATIONS)
+    if conn.tenant != username:
+        bind_tenant(conn, username)
+    return conn
+
+
+def rename_tenant(old, new):
+    # False — базу сейчас не переименовать, логин работника менять нельзя
+    if old == new:
+        return True
+
+    if STORAGE == "shared":
+        conn = DB_POOL.acquire(SHARED_DB)
+        ensure_schema(conn, SHARED_DB, SHARED_MIGRATIONS)
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        # data_version — первой: триггеры tenant_products заводят счётчик под новым именем,
+        # а остатки по размерам они переносят сами
+        for name in ("data_version", "products", "sales_history",
+                     "sales_daily", "sales_product_daily", "sales_product_total",
+                     "stock_movements", "movement_context", "stock_snapshot_runs", "stock_snapshots",
+                     "stock_reorder"):
+            c.execute(f"UPDATE tenant_{name} SET tenant_id=? WHERE tenant_id=?", (new, old))
+        conn.commit()
+        conn.close()
+        return True
+
+    # отдельные файлы: переименовываем, только если файл больше никто не держит
+    # открытым — ни другие процессы gunicorn, ни запросы этого процесса.
+    # Иначе их запись ушла бы в -wal старого имени и потерялась
+    old_path = worker_db_path(old)
+    new_path = worker_db_path(new)
+    if not os.path.exists(old_path):
+        return True
+    if os.path.exists(new_path):
+        return False
+
+    forget_db(old_path)
+    conn = sqlite3.connect(old_path, timeout=0.5, isolation_level=None)
+    try:
+        # в режиме EXCLUSIVE блокировка не отпускается до close(): её не получить,
+        # пока у файла есть другие соединения, и никто не откроет его до переименования
+        conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+        conn.execute("BEGIN EXCLUSIVE")
+        conn.execute("COMMIT")
+        busy = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+        if busy:
+            return False
+        # без WAL файл самодостаточен: -wal и -shm SQLite удаляет сам
+        conn.execute("PRAGMA journal_mode=DELETE")
+        os.replace(old_path, new_path)
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+    return True
+
+
+@app.cli.command("migrate-to-shared")
+def migrate_to_shared_command():
+    """Перенести базы <username>.db в общую tenants.db."""
+    conn = DB_POOL.acquire(SHARED_DB)
+    ensure_schema(conn, SHARED_DB, SHARED_MIGRATIONS)
+    c = conn.cursor()
+
+    for username in tenant_files():
+        path = worker_db_path(username)
+        src = DB_POOL.acquire(path)
+        ensure_schema(src, path, WORKER_MIGRATIONS)
+        src.close()
+
+        c.execute("ATTACH DATABASE ? AS src", (path,))
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT 1 FROM tenant_products WHERE tenant_id=? LIMIT 1", (username,))
+            has_products = c.fetchone()
+            c.execute("SELECT 1 FROM tenant_sales_history WHERE tenant_id=? LIMIT 1", (username,))
+            if has_products or c.fetchone():
+                conn.rollback()
+                print(f"{username}: already migrated, skipped")
+                continue
+
+            # id в общей таблице сквозные — сдвигаем их, сохраняя связь продаж с товарами
+            product_offset = c.execute("SELECT IFNULL(MAX(id), 0) FROM tenant_products").fetchone()[0]
+            sale_offset = c.execute("SELECT IFNULL(MAX(id), 0) FROM tenant_sales_history").fetchone()[0]
+
+            c.execute("""
+                INSERT INTO tenant_products
+                    (id, tenant_id, name, description, barcode, qr_code, quantity, image, category, size, height)
+                SELECT id + ?, ?, name, description, barcode, qr_code, quantity, image, category, size, height
+                FROM src.products ORDER BY id
+            """, (product_offset, username))
+            products = c.rowcount
+            c.execute("""
+                INSERT INTO tenant_sales_history (id, tenant_id, product_id, name, barcode, quantity, sale_time)
+                SELECT id + ?, ?, product_id + ?, name, barcode, quantity, sale_time
+                FROM src.sales_history ORDER BY id
+            """, (sale_offset, username, product_offset))
+            sales = c.rowcount
+
+            # вставка товаров записала в журнал движения 'create' — заменяем
+            # их журналом и снимками из файла работника
+            c.execute("DELETE FROM tenant_stock_movements WHERE tenant_id=?", (username,))
+            movement_offset = c.execute("SELECT IFNULL(MAX(id), 0) FROM tenant_stock_movements").fetchone()[0]
+            c.execute("""
+                INSERT INTO tenant_stock_movements (id, tenant_id, product_id, delta, reason, moved_at)
+                SELECT id + ?, ?, product_id + ?, delta, reason, moved_at
+                FROM src.stock_movements ORDER BY id
+            """, (movement_offset, username, product_offset))
+            c.execute("""
+                INSERT INTO tenant_stock_snapshot_runs (tenant_id, snapshot_at, movement_id)
+                SELECT ?, snapshot_at, movement_id + ? FROM src.stock_snapshot_runs
+            """, (username, movement_offset))
+            c.execute("""
+                INSERT INTO tenant_stock_snapshots (tenant_id, snapshot_at, product_id, quantity)
+                SELECT ?, snapshot_at, product_id + ?, quantity FROM src.stock_snapshots
+            """, (username, product_offset))
+            conn.commit()
+            print(f"{username}: {products} products, {sales} sales")
+        finally:
+            c.execute("DETACH DATABASE src")
+
+    conn.close()
+
+
+# ================== UPLOADS ==================
+# файлы хранятся по хэшу содержимого: одинаковые картинки лежат один раз,
+# а одноимённые загрузки больше не затирают друг друга
+
+IMAGE_VARIANTS = {
+    "thumb": (80, 80),      # список товаров (40px, x2 для плотных экранов)
+    "medium": (320, 320),   # карточка товара
+}
+# расширение берём из формата содержимого, а не из имени файла от клиента:
+# иначе evil.html отдавался бы из /static/uploads как страница
+IMAGE_FORMATS = {"JPEG": ".jpg", "PNG": ".png", "GIF": ".gif", "WEBP": ".webp"}
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+)
+HASHED_NAME_RE = re.compile(r"^[0-9a-f]{32}\.(jpg|png|gif|webp)$")
+VARIANT_NAME_RE = re.compile(r"^[0-9a-f]{32}_[a-z]+\.webp$")
+
+
+def variant_name(image_name, variant):
+    return f"{os.path.splitext(image_name)[0]}_{variant}.webp"
+
+
+def make_variants(path):
+    if Image is None:
+        return
+    base_name = os.path.basename(path)
+    try:
+        with Image.open(path) as img:
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA")
+            for variant, size in IMAGE_VARIANTS.items():
+                out = os.path.join(UPLOAD_FOLDER, variant_name(base_name, variant))
+                if os.path.exists(out):
+                    continue
+                if variant == "thumb":
+                    # как object-fit: cover в шаблоне
+                    small = ImageOps.fit(img, size)
+                else:
+                    small = img.copy()
+                    small.thumbnail(size)
+                small.save(out, "WEBP", quality=80, method=4)
+    except OSError:
+        # не картинка или битый файл — остаётся только оригинал
+        pass
+
+
+def image_format(path):
+    if Image is not None:
+        try:
+            with Image.open(path) as img:
+                return img.format
+        except (OSError, Image.DecompressionBombError):
+            return None
+
+    # без Pillow — по сигнатуре в начале файла
+    with open(path, "rb") as f:
+        head = f.read(12)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    for magic, fmt in IMAGE_SIGNATURES:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+def store_file(stream):
+    digest = hashlib.sha256()
+    tmp_path = os.path.join(UPLOAD_FOLDER, f".upload-{os.getpid()}-{threading.get_ident()}")
+
+    with open(tmp_path, "wb") as out:
+        for chunk in iter(lambda: stream.read(65536), b""):
+            digest.update(chunk)
+            out.write(chunk)
+
+    ext = IMAGE_FORMATS.get(image_format(tmp_path))
+    if ext is None:
+        os.remove(tmp_path)
+        raise ValueError("Файл не является картинкой (JPEG, PNG, GIF или WebP)")
+
+    name = digest.hexdigest()[:32] + ext
+    path = os.path.join(UPLOAD_FOLDER, name)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+
+    make_variants(path)
+    return name
+
+
+def save_upload(image_file):
+    if not image_file or not image_file.filename:
+        return None
+    try:
+        return store_file(image_file.stream)
+    except ValueError as exc:
+        abort(400, str(exc))
+
+
+@app.template_global()
+def upload_url(image_name, variant=None):
+    if variant and image_name:
+        small = variant_name(image_name, variant)
+        if os.path.exists(os.path.join(UPLOAD_FOLDER, small)):
+            image_name = small
+    if image_name and is_hashed_upload(image_name):
+        # имя уже и есть хэш содержимого
+        return f"/static/uploads/{image_name}"
+    return static_url(f"uploads/{image_name}")
+
+
+def is_hashed_upload(name):
+    return bool(HASHED_NAME_RE.match(name) or VARIANT_NAME_RE.match(name))
+
+
+# ================== STATIC CACHE ==================
+# /static/<file>?v=<хэш> отдаётся с кэшем на год: при изменении файла
+# меняется и ссылка. без отпечатка — обычные ETag / Last-Modified от Flask
+
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+STATIC_MAX_AGE = 31536000
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+def file_fingerprint(filename):
+    path = os.path.join(STATIC_DIR, filename)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _fingerprints.get(filename)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    fingerprint = digest.hexdigest()[:12]
+
+    with _fingerprints_lock:
+        _fingerprints[filename] = (key, fingerprint)
+    return fingerprint
+
+
+def build_static_manifest():
+    # отпечатки css/js считаются один раз при старте, загрузки — по первому запросу
+    for root, dirs, files in os.walk(STATIC_DIR):
+        if os.path.abspath(root) == os.path.abspath(UPLOAD_FOLDER):
+            dirs[:] = []
+            continue
+        for fname in files:
+            rel = os.path.relpath(os.path.join(root, fname), STATIC_DIR).replace(os.sep, "/")
+            file_fingerprint(rel)
+
+
+@app.template_global()
+def static_url(filename):
+    fingerprint = file_fingerprint(filename)
+    if fingerprint is None:
+        return f"/static/{filename}"
+    return f"/static/{filename}?v={fingerprint}"
+
+
+@app.after_request
+def static_cache_headers(response):
+    if not request.path.startswith("/static/") or response.status_code != 200:
+        return response
+
+    filename = request.path[len("/static/"):]
+    version = request.args.get("v")
+    immutable = (
+        (version and version == file_fingerprint(filename))
+        or (filename.startswith("uploads/") and is_hashed_upload(filename[len("uploads/"):]))
+    )
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+
+if os.environ.get("BRATEX_STATIC_MANIFEST", "1") == "1":
+    build_static_manifest()
+
+
+@app.cli.command("backfill-images")
+@click.option("--prune", is_flag=True, help="Удалить старые файлы после переноса.")
+def backfill_images_command(prune):
+    """Перевести старые загрузки на хранение по хэшу и сделать уменьшенные копии."""
+    renamed = {}
+    for fname in sorted(os.listdir(UPLOAD_FOLDER)):
+        path = os.path.join(UPLOAD_FOLDER, fname)
+        if fname.startswith(".") or not os.path.isfile(path):
+            continue
+        if VARIANT_NAME_RE.match(fname):
+            continue
+        if HASHED_NAME_RE.match(fname):
+            make_variants(path)
+            continue
+        try:
+            with open(path, "rb") as f:
+                renamed[fname] = store_file(f)
+        except ValueError:
+            print(f"{fname}: not an image, skipped")
+
+    for username in tenant_usernames():
+        conn = get_worker_db(username)
+        c = conn.cursor()
+        for old_name, new_name in renamed.items():
+            c.execute("UPDATE products SET image=? WHERE image=?", (new_name, old_name))
+        conn.commit()
+        conn.close()
+
+    for old_name, new_name in renamed.items():
+        print(f"{old_name} -> {new_name}")
+        if prune:
+            os.remove(os.path.join(UPLOAD_FOLDER, old_name))
+
+    print(f"files: {len(renamed)}, unique: {len(set(renamed.values()))}")
+
+
+# ================== AUTH ==================
+
+@app.route("/", methods=["GET", "POST"])
+def login():
+    error = None
+
+    if request.method == "POST":
+        username = request.form.get("login")
+        password = request.form.get("password")
+
+        conn = get_users_db()
+        c = conn.cursor()
+        c.execute("SELECT * FROM users WHERE username=? AND password=?", (username, password))
+        user = c.fetchone()
+        conn.close()
+
+        if user:
+            session["user"] = username
+            session["uid"] = user["id"]
+            session["type"] = user["type"]
+            if user["type"] == "admin":
+                return redirect("/admin_workers_panel")
+            else:
+                return redirect("/worker")
+        else:
+            error = "Неверный логин или пароль"
+
+    return render_template("login.html", error=error)
+
+
+@app.before_request
+def follow_worker_session():
+    # сессия работника держит его id: после смены логина она идёт за новым
+    # именем (и новой базой), после удаления работника — сбрасывается
+    if session.get("type") != "worker" or request.endpoint == "static":
+        return
+
+    conn = get_users_db()
+    # data_version растёт, когда users.db записало другое соединение (другой
+    # процесс), total_changes — когда это же. Пока оба на месте, ответ из кэша
+    # соединения: обычный запрос работника не читает таблицу users
+    version = (conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes)
+    if conn.worker_names is None or conn.worker_names[0] != version:
+        conn.worker_names = (version, {})
+    names = conn.worker_names[1]
+
+    key = session.get("uid", session["user"])
+    if key not in names:
+        c = conn.cursor()
+        if "uid" in session:
+            c.execute("SELECT id, username FROM users WHERE id=? AND type='worker'", (session["uid"],))
+        else:
+            c.execute("SELECT id, username FROM users WHERE username=? AND type='worker'", (session["user"],))
+        names[key] = c.fetchone()
+    row = names[key]
+    conn.close()
+
+    if row is None:
+        session.clear()
+    elif session.get("uid") != row["id"] or session["user"] != row["username"]:
+        session["uid"] = row["id"]
+        session["user"] = row["username"]
+
+
+@app.route("/logout")
+def logout():
+    session.clear()
+    return redirect("/")
+
+
+# ================== ADMIN ==================
+
+@app.route("/admin")
+def admin_panel():
+    if session.get("type") != "admin":
+        return redirect("/")
+
+    conn = get_users_db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM users WHERE username != 'admin'")
+    users = c.fetchall()
+    conn.close()
+
+    return render_template("admin_panel.html", users=users)
+
+
+@app.route("/admin/create_user", methods=["POST"])
+def create_user():
+    if session.get("type") != "admin":
+        return redirect("/")
+
+    username = request.form.get("username")
+    password = request.form.get("password")
+
+    conn = get_users_db()
+    c = conn.cursor()
+    c.execute("INSERT INTO users (username, password, type) VALUES (?, ?, ?)", (username, password, "worker"))
+    conn.commit()
+    conn.close()
+
+    init_worker_db(username)
+
+    return redirect("/admin")
+
+
+def insert_product(conn, category):
+    # товар из формы добавления. id берём как MAX(id) под блокировкой записи:
+    # в общей базе products — представление, и ни lastrowid, ни RETURNING
+    # не видят id, присвоенный триггером
+    c = conn.cursor()
+    name = request.form.get("name")
+    description = request.form.get("description")
+    barcode = request.form.get("barcode")
+    qr_code = request.form.get("qr_code")
+    quantity = request.form.get("quantity")
+    size = request.form.get("size")
+    height = request.form.get("height")
+
+    image_name = save_upload(request.files.get("image"))
+
+    c.execute("BEGIN IMMEDIATE")
+    c.execute("""
+        INSERT INTO products (name, description, barcode, qr_code, quantity, image, category, size, height)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (name, description, barcode, qr_code, quantity, image_name, category, size, height))
+    c.execute("SELECT MAX(id) FROM products")
+    product_id = c.fetchone()[0]
+    conn.commit()
+    return product_id
+
+
+@app.route("/admin/user/<username>")
+def view_user(username):
+    if session.get("type") != "admin":
+        return redirect("/")
+
+    conn = get_users_db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM users WHERE username=?", (username,))
+    user = c.fetchone()
+    conn.close()
+
+    return render_template("admin_user_card.html", user=user)
+
+
+def category_total(c, category):
+    # число товаров категории без COUNT(*) по products: stock_by_size ведут триггеры,
+    # в нём по строке на (размер, рост), так что сумма читает пару десятков строк
+    c.execute("SELECT IFNULL(SUM(items), 0) FROM stock_by_size WHERE category=?", (category,))
+    return c.fetchone()[0]
+
+
+@app.route("/admin/user/<username>/<category>", methods=["GET", "POST"])
+def admin_user_products(username, category):
+    if session.get("type") != "admin":
+        return redirect("/")
+
+    conn = get_worker_db(username)
+    c = conn.cursor()
+
+    search = request.args.get("search", "").strip()
+
+    if request.method == "POST":
+        insert_product(conn, category)
+
+    etag = page_etag(c, username, "products")
+    if request.method == "GET":
+        response = not_modified(etag)
+        if response:
+            conn.close()
+            return response
+
+    page = None
+    if search:
+        products = search_products(c, category, search)
+    else:
+        page = keyset_page(c, "products", "category=?", (category,))
+        page["total"] = category_total(c, category)
+        products = page["rows"]
+
+    conn.close()
+
+    return etag_response(render_template(
+        "products_list.html",
+        products=products,
+        category=category,
+        user=username,
+        is_admin=True,
+        search=search,
+        page=page
+    ), etag)
+
+
+@app.route("/admin/user/<username>/<category>/row", methods=["POST"])
+def admin_add_product_row(username, category):
+    # добавить товар и вернуть только его строку — JS вставит её в список
+    if session.get("type") != "admin":
+        return redirect("/")
+
+    conn = get_worker_db(username)
+    product_id = insert_product(conn, category)
+    c = conn.cursor()
+    c.execute("SELECT * FROM products WHERE id=?", (product_id,))
+    product = c.fetchone()
+    conn.close()
+
+    return render_template("product_row.html", p=product, user=username,
+                           category=category, is_admin=True)
+
+
+# ================== SEARCH ==================
+
+SEARCH_LIMIT = 200
+
+
+def fts_query(search):
+    # каждое слово — префиксный поиск, слова объединяются через AND.
+    # слово режем по знакам так же, как токенизатор при индексации:
+    # "ABC-123" -> "ABC"* "123"*, а не склеенное "ABC123"
+    tokens = []
+    for word in re.split(r"[\W_]+", search):
+        if word:
+            tokens.append(f'"{word}"*')
+    return " ".join(tokens)
+
+
+def code_like(search):
+    # одно «слово» с цифрами — скорее всего штрихкод или его часть
+    return len(search.split()) == 1 and any(ch.isdigit() for ch in search)
+
+
+def search_products(c, category, search):
+    query = fts_query(search)
+    if FTS5_AVAILABLE and query:
+        try:
+            c.execute("""
+                SELECT p.* FROM products_fts
+                JOIN products p ON p.id = products_fts.rowid
+                WHERE products_fts MATCH ? AND p.category=?
+                ORDER BY bm25(products_fts, 10.0, 1.0, 5.0, 5.0)
+                LIMIT ?
+            """, (query, category, SEARCH_LIMIT))
+            rows = c.fetchall()
+            # FTS ищет только с начала слова, а код вводят и с середины ("3456" из "0123456")
+            if rows or not code_like(search):
+                return rows
+        except sqlite3.OperationalError:
+            # база ещё без products_fts — ищем по-старому
+            pass
+
+    like = f"%{search}%"
+    c.execute("""
+        SELECT * FROM products
+        WHERE category=? AND (name LIKE ? OR barcode LIKE ? OR qr_code LIKE ?)
+        LIMIT ?
+    """, (category, like, like, like, SEARCH_LIMIT))
+    return c.fetchall()
+
+
+# ================== PAGINATION ==================
+
+PAGE_SIZE = int(os.environ.get("BRATEX_PAGE_SIZE", "50"))
+PAGE_SIZE_MAX = 500
+
+
+def keyset_page(c, table, where, params, newest_first=False):
+    # курсор — id крайней строки страницы: ?after=<id> вперёд, ?before=<id> назад
+    limit = request.args.get("limit", PAGE_SIZE, type=int)
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+
+    backwards = before is not None
+    cursor = before if backwards else after
+
+    # вперёд по странице = по возрастанию id, если не newest_first
+    ascending = newest_first == backwards
+    cond = where
+    args = list(params)
+    if cursor is not None:
+        cond += " AND id > ?" if ascending else " AND id < ?"
+        args.append(cursor)
+
+    c.execute(
+        f"SELECT * FROM {table} WHERE {cond} ORDER BY id {'ASC' if ascending else 'DESC'} LIMIT ?",
+        args + [limit + 1]
+    )
+    rows = c.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if backwards:
+            next_cursor = rows[-1]["id"]
+            prev_cursor = rows[0]["id"] if more else None
+        else:
+            next_cursor = rows[-1]["id"] if more else None
+            prev_cursor = rows[0]["id"] if after is not None else None
+
+    return {
+        "rows": rows,
+        "limit": limit,
+        "next": next_cursor,
+        "prev": prev_cursor,
+        "total": None,
+    }
+
+
+# ================== CONDITIONAL GET ==================
+# страницы работника отдают ETag из счётчиков data_version: пока товары
+# и продажи не менялись, обновление страницы — один маленький SELECT и 304
+# без запроса списка и рендера шаблона
+
+def _page_build():
+    # код и шаблоны меняются при деплое — старые ETag тогда не годятся.
+    # считаем по mtime/размеру, одинаково во всех процессах
+    digest = hashlib.sha256()
+    paths = [os.path.join(BASE_DIR, "app.py")]
+    for folder in (app.template_folder, "static"):
+        root = os.path.join(BASE_DIR, folder)
+        for dirpath, dirs, files in os.walk(root):
+            if os.path.abspath(dirpath) == os.path.abspath(UPLOAD_FOLDER):
+                dirs[:] = []
+                continue
+            paths.extend(os.path.join(dirpath, f) for f in files)
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        digest.update(f"{path}:{st.st_mtime_ns}:{st.st_size}".encode())
+    return digest.hexdigest()[:12]
+
+
+PAGE_BUILD = _page_build()
+
+
+def page_etag(c, username, *names):
+    marks = ",".join("?" * len(names))
+    c.execute(f"SELECT name, version FROM data_version WHERE name IN ({marks})", names)
+    versions = dict(c.fetchall())
+    raw = ":".join([PAGE_BUILD, session.get("user", ""), username or "", request.full_path]
+                   + [str(versions.get(name, 0)) for name in names])
+    return hashlib.sha256(raw.encode()).hexdigest()[:24]
+
+
+def _revalidate(response, etag):
+    # браузер хранит страницу, но каждый раз спрашивает сервер
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+
+def not_modified(etag):
+    if etag in request.if_none_match:
+        return _revalidate(Response(status=304), etag)
+    return None
+
+
+def etag_response(body, etag):
+    return _revalidate(app.make_response(body), etag)
+
+
+# ================== WORKER MENU ==================
+
+@app.route("/worker")
+def worker_menu():
+    if "user" not in session or session.get("type") != "worker":
+        return redirect("/")
+
+    # список «заканчивается» готов заранее — меню читает несколько строк по индексу
+    conn = get_worker_db(session["user"])
+    maybe_snapshot(conn)
+    low = low_stock(conn, limit=REORDER_MENU_ROWS)
+    low_total = low_stock_count(conn)
+    conn.close()
+
+    return render_template("worker_menu.html", username=session["user"], low_stock=low, low_total=low_total)
+
+
+@app.route("/worker/warehouse")
+def worker_warehouse_menu():
+    if "user" not in session or session.get("type") != "worker":
+        return redirect("/")
+
+    return render_template("warehouse_menu.html", username=session["user"])
+
+
+# ================== WORKER PRODUCTS ==================
+
+@app.route("/worker/<category>", methods=["GET", "POST"])
+def worker_products(category):
+    if "user" not in session or session.get("type") != "worker":
+        return redirect("/")
+
+    username = session["user"]
+    conn = get_worker_db(username)
+    c = conn.cursor()
+
+    search = request.args.get("search", "").strip()
+
+    if request.method == "POST":
+        insert_product(conn, category)
+
+    etag = page_etag(c, username, "products")
+    if request.method == "GET":
+        response = not_modified(etag)
+        if response:
+            conn.close()
+            return response
+
+    page = None
+    if search:
+        products = search_products(c, category, search)
+    else:
+        page = keyset_page(c, "products", "category=?", (category,))
+        page["total"] = category_total(c, category)
+        products = page["rows"]
+
+    conn.close()
+
+    return etag_response(render_template(
+        "products_list.html",
+        products=products,
+        category=category,
+        user=username,
+        is_admin=False,
+        search=search,
+        page=page
+    ), etag)
+
+
+# ================== EDIT PRODUCT ==================
+
+@app.route("/product/<username>/<int:product_id>")
+def view_product(username, product_id):
+    if "user" not in session:
+        return redirect("/")
+
+    conn = get_worker_db(username)
+    c = conn.cursor()
+    c.execute("SELECT * FROM products WHERE id=?", (product_id,))
+    product = c.fetchone()
+    conn.close()
+
+    if not product:
+        return "Товар не найден", 404
+
+    return render_template("view_product.html", product=product, user=username)
+
+
+@app.route("/product/<username>/<int:product_id>/edit", methods=["GET", "POST"])
+def edit_product(username, product_id):
+    if "user" not in session:
+        return redirect("/")
+
+    # работникам запрещено редактирование
+    if session.get("type") == "worker":
+        return redirect(f"/product/{username}/{product_id}")
+
+    conn = get_worker_db(username)
+    c = conn.cursor()
+
+    if request.method == "POST":
+        name = request.form.get("name")
+        description = request.form.get("description")
+        barcode = request.form.get("barcode")
+        qr_code = request.form.get("qr_code")
+        quantity = request.form.get("quantity")
+        size = request.form.get("size")
+        height = request.form.get("height")
+
+        image_name = save_upload(request.files.get("image"))
+
+        if image_name:
+            c.execute("""
+                UPDATE products
+                SET name=?, description=?, barcode=?, qr_code=?, quantity=?, image=?
+                WHERE id=?
+            """, (name, description, barcode, qr_code, quantity, image_name, product_id))
+        else:
+            c.execute("""
+                UPDATE products
+                SET name=?, description=?, barcode=?, qr_code=?, quantity=?
+                WHERE id=?
+            """, (name, description, barcode, qr_code, quantity, product_id))
+
+        conn.commit()
+        conn.close()
+
+        return redirect(request.referrer)
+
+    c.execute("SELECT * FROM products WHERE id=?", (product_id,))
+    product = c.fetchone()
+    conn.close()
+
+    return render_template("edit_product.html", product=product, user=username)
+
+
+# ================== LOOKUP CACHE ==================
+
+LOOKUP_CACHE_TENANTS = int(os.environ.get("BRATEX_LOOKUP_CACHE_TENANTS", "128"))
+LOOKUP_CACHE_SIZE = int(os.environ.get("BRATEX_LOOKUP_CACHE_SIZE", "512"))
+
+_NOT_FOUND = object()
+
+
+def counter_version(c, name):
+    c.execute("SELECT version FROM data_version WHERE name=?", (name,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+
+class LookupCache:
+    # код (barcode / qr_code) -> строка товара, отдельный LRU на каждого работника.
+    # попадание — один запрос к счётчику 'products'; любая запись в товары
+    # (в любом процессе), включая продажу, сбрасывает кэш работника
+
+    def __init__(self, max_tenants, max_codes):
+        self.max_tenants = max_tenants
+        self.max_codes = max_codes
+        self._lock = threading.Lock()
+        self._tenants = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def lookup(self, username, conn, code):
+        c = conn.cursor()
+        version = counter_version(c, "products")
+
+        with self._lock:
+            entry = self._tenants.get(username)
+            if entry is not None and entry[0] != version:
+                self.invalidations += 1
+                entry = None
+            if entry is not None:
+                self._tenants.move_to_end(username)
+                codes = entry[1]
+                if code in codes:
+                    codes.move_to_end(code)
+                    self.hits += 1
+                    product = codes[code]
+                    return None if product is _NOT_FOUND else product
+            self.misses += 1
+
+        c.execute("SELECT * FROM products WHERE barcode=? OR qr_code=?", (code, code))
+        product = c.fetchone()
+
+        with self._lock:
+            entry = self._tenants.get(username)
+            if entry is None or entry[0] != version:
+                entry = (version, OrderedDict())
+                self._tenants[username] = entry
+            self._tenants.move_to_end(username)
+            codes = entry[1]
+            codes[code] = _NOT_FOUND if product is None else product
+            if len(codes) > self.max_codes:
+                codes.popitem(last=False)
+            while len(self._tenants) > self.max_tenants:
+                self._tenants.popitem(last=False)
+
+        return product
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "tenants": len(self._tenants),
+            }
+
+
+LOOKUP_CACHE = LookupCache(LOOKUP_CACHE_TENANTS, LOOKUP_CACHE_SIZE)
+
+
+# ================== SALE ==================
+
+def movement_reason(c, reason):
+    # причина изменений остатка до конца транзакции — её читают триггеры
+    # stock_movements; None — убрать перед коммитом
+    c.execute("DELETE FROM movement_context")
+    if reason:
+        c.execute("INSERT INTO movement_context (reason) VALUES (?)", (reason,))
+
+
+def apply_sale(c, items, sale_time):
+    # строки одной продажи внутри уже открытой транзакции.
+    # остаток списывается условно (quantity >= qty), поэтому две кассы
+    # не могут продать один и тот же последний товар
+    results = []
+    sales = []
+    movement_reason(c, "sale")
+
+    for code, qty in items:
+        c.execute("SELECT * FROM products WHERE barcode=? OR qr_code=?", (code, code))
+        product = c.fetchone()
+        error = None
+
+        if qty <= 0:
+            error = "Неверное количество"
+        elif not product:
+            error = "Товар не найден"
+        else:
+            # RETURNING, а не rowcount: в общей базе products — представление,
+            # и для него rowcount всегда 0
+            c.execute("UPDATE products SET quantity = quantity - ? WHERE id=? AND quantity >= ? RETURNING id",
+                      (qty, product["id"], qty))
+            if c.fetchone() is None:
+                error = "Недостаточно товара на складе"
+            else:
+                sales.append((product["id"], product["name"], product["barcode"], qty, sale_time))
+
+        results.append({"code": code, "quantity": qty, "product": product, "error": error})
+
+    c.executemany("""
+        INSERT INTO sales_history (product_id, name, barcode, quantity, sale_time)
+        VALUES (?, ?, ?, ?, ?)
+    """, sales)
+    movement_reason(c, None)
+    return results
+
+
+def sell_items(conn, items):
+    # items — [(code, qty), ...]; вся корзина в одной транзакции
+    c = conn.cursor()
+    sale_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        results = apply_sale(c, items, sale_time)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return results
+
+
+def parse_cart_form():
+    items = []
+    codes = request.form.getlist("code")
+    quantities = request.form.getlist("quantity")
+    for code, qty in zip(codes, quantities):
+        code = code.strip()
+        if not code:
+            continue
+        try:
+            qty = int(qty)
+        except ValueError:
+            qty = 0
+        items.append((code, qty))
+    return items
+
+
+def sale_context(conn, username):
+    # общее для страницы продажи и её фрагмента-карточки
+    c = conn.cursor()
+
+    error = None
+    success = None
+
+    found_product = None
+    code_value = ""
+
+    # PREVIEW по GET (после сканирования)
+    code_preview = request.args.get("code", "").strip()
+    if code_preview:
+        code_value = code_preview
+        found_product = LOOKUP_CACHE.lookup(username, conn, code_preview)
+
+    # ПРОДАЖА только по кнопке
+    if request.method == "POST":
+        code = request.form.get("code", "").strip()
+        code_value = code
+        qty = int(request.form.get("quantity", 0))
+
+        line = sell(username, conn, [(code, qty)])[0]
+        if line["error"]:
+            error = line["error"]
+            # карточка остаётся на экране, даже если форма пришла без ?code=
+            found_product = found_product or line["product"]
+        else:
+            success = "Продажа выполнена"
+
+            # показать обновлённый остаток сразу после продажи
+            c.execute("SELECT * FROM products WHERE id=?", (line["product"]["id"],))
+            found_product = c.fetchone()
+
+    return {
+        "error": error,
+        "success": success,
+        "found_product": found_product,
+        "code_value": code_value,
+    }
+
+
+@app.route("/worker/sale", methods=["GET", "POST"])
+def worker_sale():
+    if "user" not in session or session.get("type") != "worker":
+        return redirect("/")
+
+    username = session["user"]
+    conn = get_worker_db(username)
+    context = sale_context(conn, username)
+    conn.close()
+    return render_template("sale.html", **context)
+
+
+@app.route("/worker/sale/card", methods=["GET", "POST"])
+def worker_sale_card():
+    # только карточка товара — её подставляет JS на странице продажи
+    if "user" not in session or session.get("type") != "worker":
+        return redirect("/")
+
+    username = session["user"]
+    conn = get_worker_db(username)
+    context = sale_context(conn, username)
+    conn.close()
+    return render_template("sale_card.html", **context)
+
+
+
+@app.route("/worker/sale/cart", methods=["POST"])
+def worker_sale_cart():
+    if "user" not in session or session.get("type") != "worker":
+        return redirect("/")
+
+    items = parse_cart_form()
+    if not items:
+        return redirect("/worker/sale")
+
+    conn = get_worker_db(session["user"])
+    cart_results = sell(session["user"], conn, items)
+    conn.close()
+
+    sold = sum(1 for line in cart_results if not line["error"])
+    failed = len(cart_results) - sold
+
+    return render_template(
+        "sale.html",
+        error=f"Не продано позиций: {failed}" if failed else None,
+        success=f"Продано позиций: {sold}" if sold else None,
+        found_product=None,
+        code_value="",
+        cart_results=cart_results
+    )
+
+
+# ================== SALE JOURNAL ==================
+# BRATEX_GROUP_COMMIT=1 — групповой коммит продаж. Роут кладёт продажу в
+# очередь писателя своего работника и ждёт. Писатель берёт всё, что успело
+# накопиться (но не больше GROUP_COMMIT_MAX), применяет продажи в одной
+# транзакции — каждую в своём SAVEPOINT — и делает один коммит.
+# Ответ (включая ошибки по строкам) уходит только после коммита, поэтому
+# подтверждённая продажа переживает перезапуск процесса; коммит идёт с
+# synchronous=FULL — fsync делится на всю пачку
+
+GROUP_COMMIT = os.environ.get("BRATEX_GROUP_COMMIT", "0") == "1"
+# сколько ждать, добирая пачку; 0 — не ждать, брать только уже накопленное
+GROUP_COMMIT_WAIT = float(os.environ.get("BRATEX_GROUP_COMMIT_MS", "0")) / 1000
+GROUP_COMMIT_MAX = int(os.environ.get("BRATEX_GROUP_COMMIT_MAX", "64"))
+GROUP_COMMIT_SYNC = os.environ.get("BRATEX_GROUP_COMMIT_SYNC", "FULL")
+# писатель без продаж столько секунд отдаёт соединение и завершается
+GROUP_COMMIT_IDLE = 5.0
+# страховка: роут не ждёт ответа писателя дольше этого
+GROUP_COMMIT_TIMEOUT = 30.0
+
+
+class SaleWriter(threading.Thread):
+
+    def __init__(self, journal, username):
+        super().__init__(name=f"sale-writer-{username}", daemon=True)
+        self.journal = journal
+        self.username = username
+        self.queue = queue.Queue()
+
+    def run(self):
+        conn = None
+        batch = []
+        error = None
+        try:
+            conn = get_worker_db(self.username)
+            conn.execute(f"PRAGMA synchronous={GROUP_COMMIT_SYNC}")
+            while True:
+                try:
+                    job = self.queue.get(timeout=GROUP_COMMIT_IDLE)
+                except queue.Empty:
+                    if self.journal._retire(self):
+                        return
+                    continue
+                batch = self.collect(job)
+                self.commit(conn, batch)
+                batch = []
+        except Exception as exc:
+            error = exc
+            app.logger.exception("sale writer for %s failed", self.username)
+        finally:
+            # при любом выходе писатель уходит из журнала, а ждущие получают
+            # ошибку — иначе продажи работника висели бы до GROUP_COMMIT_TIMEOUT
+            self.journal._retire(self, force=True)
+            error = error or RuntimeError("sale writer stopped")
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            for items, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            if conn is not None:
+                try:
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                finally:
+                    conn.close()
+
+    def collect(self, job):
+        batch = [job]
+        deadline = time.monotonic() + GROUP_COMMIT_WAIT
+        while len(batch) < GROUP_COMMIT_MAX:
+            try:
+                if GROUP_COMMIT_WAIT:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def commit(self, conn, batch):
+        c = conn.cursor()
+        sale_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        done = []
+        start = time.perf_counter()
+
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for items, future in batch:
+                # ошибка одной продажи не должна откатить остальные
+                c.execute("SAVEPOINT sale")
+                try:
+                    done.append((future, apply_sale(c, items, sale_time)))
+                    c.execute("RELEASE sale")
+                except Exception as exc:
+                    c.execute("ROLLBACK TO sale")
+                    c.execute("RELEASE sale")
+                    done.append((future, exc))
+            conn.commit()
+        except Exception as exc:
+            if conn.in_transaction:
+                conn.rollback()
+            for items, future in batch:
+                future.set_exception(exc)
+            return
+
+        self.journal._record(len(batch), time.perf_counter() - start)
+        for future, result in done:
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class SaleJournal:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._writers = {}
+        self._pid = os.getpid()
+        self.batches = 0
+        self.sales = 0
+        self.max_batch = 0
+        self.commit_seconds = 0.0
+
+    def submit(self, username, items):
+        future = Future()
+        with self._lock:
+            # после fork потоки родителя не существуют
+            if self._pid != os.getpid():
+                self._writers = {}
+                self._pid = os.getpid()
+            writer = self._writers.get(username)
+            if writer is None:
+                writer = self._writers[username] = SaleWriter(self, username)
+                writer.start()
+            writer.queue.put((items, future))
+        return future
+
+    def _retire(self, writer, force=False):
+        # под тем же замком, что и submit: продажа не попадёт в очередь
+        # писателя, который уже решил завершиться
+        with self._lock:
+            if not force and not writer.queue.empty():
+                return False
+            if self._writers.get(writer.username) is writer:
+                del self._writers[writer.username]
+            return True
+
+    def _record(self, size, seconds):
+        with self._lock:
+            self.batches += 1
+            self.sales += size
+            self.max_batch = max(self.max_batch, size)
+            self.commit_seconds += seconds
+        METRICS.observe("bratex_group_commit_batch_size", (), size, BATCH_BUCKETS)
+        METRICS.observe("bratex_group_commit_seconds", (), seconds, SQL_BUCKETS)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": GROUP_COMMIT,
+                "writers": len(self._writers),
+                "batches": self.batches,
+                "sales": self.sales,
+                "avg_batch": round(self.sales / self.batches, 2) if self.batches else 0,
+                "max_batch": self.max_batch,
+                "avg_commit_ms": round(self.commit_seconds / self.batches * 1000, 3) if self.batches else 0,
+            }
+
+
+SALE_JOURNAL = SaleJournal()
+
+
+def sell(username, conn, items):
+    # точка входа для всех продаж: сразу или через групповой коммит
+    if GROUP_COMMIT:
+        return SALE_JOURNAL.submit(username, items).result(timeout=GROUP_COMMIT_TIMEOUT)
+    return sell_items(conn, items)
+
+
+# ================== SALES HISTORY ==================
+
+@app.route("/worker/sales_history")
+def sales_history():
+    if "user" not in session or session.get("type") != "worker":
+        return redirect("/")
+
+    username = session["user"]
+    conn = get_worker_db(username)
+    c = conn.cursor()
+
+    etag = page_etag(c, username, "sales")
+    response = not_modified(etag)
+    if response:
+        conn.close()
+        return response
+
+    page = keyset_page(c, "sales_history", "1=1", (), newest_first=True)
+    # оценка без COUNT(*): по границам id (возвраты оставляют дыры)
+    c.execute("SELECT MAX(id) - MIN(id) + 1 FROM sales_history")
+    page["total"] = c.fetchone()[0] or 0
+    conn.close()
+
+    return etag_response(render_template("sales_history.html", history=page["rows"], page=page), etag)
+
+
+# ================== DELETE ==================
+
+@app.route("/delete_product/<username>/<int:product_id>/<category>")
+def delete_product(username, product_id, category):
+    if "user" not in session:
+        return redirect("/")
+
+    conn = get_worker_db(username)
+    c = conn.cursor()
+    c.execute("DELETE FROM products WHERE id=?", (product_id,))
+    conn.commit()
+    conn.close()
+
+    if session.get("user") == "admin":
+        return redirect(f"/admin/user/{username}/{category}")
+    else:
+        return redirect(f"/worker/{category}")
+
+
+
+@app.route("/admin/create_admin", methods=["POST"])
+def create_admin():
+    if session.get("type") != "admin":
+        return redirect("/")
+
+    login = request.form.get("login","").strip()
+    password = request.form.get("password","").strip()
+    password2 = request.form.get("password2","").strip()
+
+    if not login or not password:
+        return redirect("/admin")
+
+    if password != password2:
+        return redirect("/admin")
+
+    conn = get_users_db()
+    c = conn.cursor()
+    c.execute("INSERT INTO users (username, password, type) VALUES (?, ?, ?)", (login, password, "admin"))
+    conn.commit()
+    conn.close()
+
+    return redirect("/admin")
+
+
+@app.route("/admin/admins")
+def admins_list():
+    if session.get("type") != "admin":
+        return redirect("/")
+
+    conn = get_users_db()
+    c = conn.cursor()
+    c.execute("SELECT username, password FROM users WHERE type='admin' AND username != 'admin'")
+    admins = c.fetchall()
+    conn.close()
+
+    return render_template("admins_list.html", admins=admins)
+
+
+
+
+@app.route("/admin_workers_panel/create_worker", methods=["POST"])
+def create_worker_by_admin():
+    if "user" not in session:
+        return redirect("/")
+
+    if session.get("type") != "admin":
+        return redirect("/")
+
+    # обычный админ создаёт работника
+    username = request.form.get("username")
+    password = request.form.get("password")
+
+    if not username or not password:
+        return redirect("/admin_workers_panel")
+
+    conn = get_users_db()
+    c = conn.cursor()
+    c.execute("INSERT INTO users (username, password, type, owner_admin) VALUES (?, ?, ?, ?)",
+              (username, password, "worker", session.get("user")))
+    conn.commit()
+    conn.close()
+
+    init_worker_db(username)
+
+    return redirect("/admin_workers_panel")
+
+
+# ================== ADMIN WORKERS PANEL ==================
+
+@app.route("/admin_workers_panel")
+def admin_workers_panel():
+    if "user" not in session:
+        return redirect("/")
+
+    if session.get("type") != "admin":
+        return redirect("/")
+
+    if session.get("user") == "admin":
+        return redirect("/admin")
+
+    # список работников (все кроме admin-аккаунтов)
+    conn = get_users_db()
     c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE id=?", (product_id,))
-    product = c.fetchone()
+    c.execute("SELECT * FROM users WHERE type='worker' AND owner_admin=?", (session.get("user"),))
+    workers = c.fetchall()
     conn.close()
 
-    if not product:
-        return "Товар не найден", 404
+    return render_template("admin_workers_panel.html", workers=workers)
 
-    return render_template("view_product.html", product=product, user=username)
 
 
-@app.route("/product/<username>/<int:product_id>/edit", methods=["GET", "POST"])
-def edit_product(username, product_id):
+@app.route("/admin/delete_worker/<username>")
+def delete_worker(username):
+    if "user" not in session or session.get("type") != "admin":
+        return redirect("/")
+
+    conn = get_users_db()
+    c = conn.cursor()
+    c.execute("DELETE FROM users WHERE username=? AND type='worker'", (username,))
+    conn.commit()
+    conn.close()
+
+    # файл базы остаётся на диске — его найдёт и уберёт flask maintenance
+    if STORAGE == "files":
+        forget_db(worker_db_path(username))
+    return redirect("/admin_workers_panel")
+
+
+@app.route("/admin/edit_worker/<username>", methods=["GET","POST"])
+def edit_worker(username):
+    if "user" not in session or session.get("type") != "admin":
+        return redirect("/")
+
+    conn = get_users_db()
+    c = conn.cursor()
+
+    error = None
+    if request.method=="POST":
+        new_name=request.form.get("new_username")
+        new_pass=request.form.get("new_password")
+        if new_name and new_name != username:
+            c.execute("SELECT 1 FROM users WHERE username=?", (new_name,))
+            if c.fetchone():
+                error = "Такой логин уже есть"
+            # база работника привязана к логину — переносим её до смены логина
+            elif not rename_tenant(username, new_name):
+                error = "База работника сейчас открыта — повторите позже"
+            else:
+                c.execute("UPDATE users SET username=? WHERE username=?", (new_name, username))
+                username=new_name
+        if new_pass:
+            c.execute("UPDATE users SET password=? WHERE username=?", (new_pass, username))
+        conn.commit()
+        if not error:
+            conn.close()
+            return redirect("/admin_workers_panel")
+
+    c.execute("SELECT * FROM users WHERE username=?", (username,))
+    worker=c.fetchone()
+    conn.close()
+    return render_template("edit_worker.html", worker=worker, error=error)
+
+
+
+@app.route("/size_table")
+def size_table():
     if "user" not in session:
         return redirect("/")
+    return render_template("size_table.html", title="Размеры")
 
-    # работникам запрещено редактирование
+
+
+@app.route("/admin/size_manage")
+def admin_size_manage():
+    if "user" not in session:
+        return redirect("/")
+    if session.get("type") != "admin":
+        return redirect("/size_table")
+    return render_template("size_admin.html")
+
+
+
+
+
+@app.route("/worker/<category>/table")
+def worker_size_table(category):
+    if "user" not in session:
+        return redirect("/")
+    username = target_username()
+    conn = get_worker_db(username)
+    c = conn.cursor()
+
+    # stock_by_size меняется только вместе с товарами
+    etag = page_etag(c, username, "products")
+    response = not_modified(etag)
+    if response:
+        conn.close()
+        return response
+
+    c.execute("SELECT size, height, quantity as qty FROM stock_by_size WHERE category=?", (category,))
+    rows = c.fetchall()
+    conn.close()
+    data = {(r["size"], r["height"]): r["qty"] for r in rows}
+    title = "Мужские размеры" if category=="male" else "Женские размеры"
+    return etag_response(render_template("size_table.html", title=title, data=data), etag)
+
+
+
+
+@app.cli.command("stock-summary")
+@click.option("--rebuild", is_flag=True, help="Пересобрать таблицу при расхождении.")
+def stock_summary_command(rebuild):
+    """Сверить stock_by_size с товарами во всех базах работников."""
+    for username in tenant_usernames():
+        conn = get_worker_db(username)
+        c = conn.cursor()
+        c.execute("""
+            SELECT category, size, height, quantity, items FROM stock_by_size
+            EXCEPT
+            SELECT IFNULL(category, ''), IFNULL(size, ''), IFNULL(height, ''),
+                   IFNULL(SUM(quantity), 0), COUNT(*)
+            FROM products
+            GROUP BY IFNULL(category, ''), IFNULL(size, ''), IFNULL(height, '')
+        """)
+        extra = c.fetchall()
+        c.execute("""
+            SELECT IFNULL(category, ''), IFNULL(size, ''), IFNULL(height, ''),
+                   IFNULL(SUM(quantity), 0), COUNT(*)
+            FROM products
+            GROUP BY IFNULL(category, ''), IFNULL(size, ''), IFNULL(height, '')
+            EXCEPT
+            SELECT category, size, height, quantity, items FROM stock_by_size
+        """)
+        missing = c.fetchall()
+
+        if not extra and not missing:
+            print(f"{username}: ok")
+        else:
+            print(f"{username}: {len(extra) + len(missing)} mismatched rows")
+            if rebuild:
+                c.execute("BEGIN IMMEDIATE")
+                rebuild_stock_by_size(c)
+                conn.commit()
+                print(f"{username}: rebuilt")
+        conn.close()
+
+
+# ================== RETURN SALE ==================
+
+def return_items(conn, sale_id, qty):
+    # возврат всей продажи или её части одной транзакцией;
+    # остаток увеличиваем относительно, а не перезаписываем прочитанным значением
+    c = conn.cursor()
+    error = None
+
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("SELECT * FROM sales_history WHERE id=?", (sale_id,))
+        sale = c.fetchone()
+
+        if not sale:
+            error = "Продажа не найдена"
+        elif qty <= 0 or qty > sale["quantity"]:
+            error = "Неверное количество"
+        else:
+            movement_reason(c, "return")
+            c.execute("UPDATE products SET quantity = quantity + ? WHERE id=?", (qty, sale["product_id"]))
+            movement_reason(c, None)
+
+            # если вернули полностью — удаляем продажу
+            if qty == sale["quantity"]:
+                c.execute("DELETE FROM sales_history WHERE id=?", (sale_id,))
+            else:
+                # если частично — уменьшаем количество в истории
+                c.execute("UPDATE sales_history SET quantity = quantity - ? WHERE id=?", (qty, sale_id))
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return sale, error
+
+
+@app.route("/worker/return_sale/<int:sale_id>", methods=["POST"])
+def return_sale(sale_id):
+    if "user" not in session or session.get("type") != "worker":
+        return redirect("/")
+
+    username = session["user"]
+    conn = get_worker_db(username)
+
+    return_qty = int(request.form.get("return_qty", 0))
+    return_items(conn, sale_id, return_qty)
+
+    conn.close()
+    return redirect("/worker/sales_history")
+
+
+
+
+@app.route("/admin/change_admin_password/<username>", methods=["POST"])
+def change_admin_password(username):
+    if session.get("user") != "admin":
+        return redirect("/")
+
+    new_pass = request.form.get("new_password","").strip()
+    if not new_pass:
+        return redirect("/admin/admins")
+
+    conn = get_users_db()
+    c = conn.cursor()
+    c.execute("UPDATE users SET password=? WHERE username=? AND type='admin'", (new_pass, username))
+    conn.commit()
+    conn.close()
+
+    return redirect("/admin/admins")
+
+
+# ================== SCANNER API ==================
+# JSON для ручных сканеров: те же пути, что у /worker/sale и возврата,
+# но без рендера страниц. Вход — сессия работника или
+# заголовок "Authorization: Bearer <token>" (токен выдаёт POST /api/token)
+
+API_BATCH_LIMIT = int(os.environ.get("BRATEX_API_BATCH_LIMIT", "500"))
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def api_user():
     if session.get("type") == "worker":
-        return redirect(f"/product/{username}/{product_id}")
+        return session["user"]
+
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        return None
+
+    conn = get_users_db()
+    c = conn.cursor()
+    c.execute("SELECT username FROM users WHERE api_token=? AND type='worker'",
+              (hash_token(auth[7:].strip()),))
+    row = c.fetchone()
+    conn.close()
+    return row["username"] if row else None
+
+
+def api_error(message, status=400):
+    return jsonify({"error": message}), status
+
+
+def api_data():
+    # тело — JSON-объект или форма; список и прочее — None, роут отвечает 400
+    data = request.get_json(silent=True)
+    if data is None:
+        return request.form
+    return data if isinstance(data, dict) else None
+
+
+def product_json(product, quantity=None):
+    if product is None:
+        return None
+    return {
+        "id": product["id"],
+        "name": product["name"],
+        "barcode": product["barcode"],
+        "qr_code": product["qr_code"],
+        "quantity": product["quantity"] if quantity is None else quantity,
+        "category": product["category"],
+        "size": product["size"],
+        "height": product["height"],
+    }
+
+
+def lookup_codes(c, codes):
+    # все коды одним запросом; при совпадении нескольких товаров
+    # берём первый по id — как SELECT ... fetchone() в одиночном поиске
+    marks = ",".join("?" * len(codes))
+    c.execute(f"""
+        SELECT * FROM products WHERE barcode IN ({marks}) OR qr_code IN ({marks})
+        ORDER BY id
+    """, codes + codes)
+    found = {}
+    for row in c.fetchall():
+        for code in (row["barcode"], row["qr_code"]):
+            if code is not None and code not in found:
+                found[code] = row
+    return {code: found.get(code) for code in codes}
+
+
+@app.route("/api/token", methods=["POST", "DELETE"])
+def api_token():
+    conn = get_users_db()
+    c = conn.cursor()
+
+    if request.method == "DELETE":
+        username = api_user()
+        if not username:
+            conn.close()
+            return api_error("Требуется вход", 401)
+        c.execute("UPDATE users SET api_token=NULL WHERE username=?", (username,))
+        conn.commit()
+        conn.close()
+        return jsonify({"ok": True})
+
+    data = api_data()
+    if data is None:
+        conn.close()
+        return api_error("Неверные данные")
+    c.execute("SELECT * FROM users WHERE username=? AND password=? AND type='worker'",
+              (data.get("login"), data.get("password")))
+    user = c.fetchone()
+    if not user:
+        conn.close()
+        return api_error("Неверный логин или пароль", 401)
+
+    # новый токен заменяет прежний
+    token = secrets.token_urlsafe(32)
+    c.execute("UPDATE users SET api_token=? WHERE id=?", (hash_token(token), user["id"]))
+    conn.commit()
+    conn.close()
+    return jsonify({"token": token})
+
+
+@app.route("/api/lookup")
+def api_lookup():
+    username = api_user()
+    if not username:
+        return api_error("Требуется вход", 401)
+
+    code = request.args.get("code", "").strip()
+    if not code:
+        return api_error("Не указан код")
+
+    conn = get_worker_db(username)
+    product = LOOKUP_CACHE.lookup(username, conn, code)
+    conn.close()
+    return jsonify({"code": code, "product": product_json(product)})
+
+
+@app.route("/api/lookup/batch", methods=["POST"])
+def api_lookup_batch():
+    username = api_user()
+    if not username:
+        return api_error("Требуется вход", 401)
+
+    data = api_data()
+    if data is None or not isinstance(data.get("codes") or [], list):
+        return api_error("Неверные данные")
+    codes = [str(code).strip() for code in data.get("codes") or [] if str(code).strip()]
+    codes = list(dict.fromkeys(codes))
+    if not codes:
+        return api_error("Не указаны коды")
+    if len(codes) > API_BATCH_LIMIT:
+        return api_error(f"Не больше {API_BATCH_LIMIT} кодов за запрос")
+
+    conn = get_worker_db(username)
+    found = lookup_codes(conn.cursor(), codes)
+    conn.close()
+    return jsonify({"products": {code: product_json(row) for code, row in found.items()}})
+
+
+@app.route("/api/sale", methods=["POST"])
+def api_sale():
+    # {"code": ..., "quantity": ...} или корзина {"items": [{"code": ..., "quantity": ...}, ...]}
+    username = api_user()
+    if not username:
+        return api_error("Требуется вход", 401)
+
+    data = api_data()
+    if data is None:
+        return api_error("Неверные данные")
+    lines = data.get("items") if isinstance(data.get("items"), list) else [data]
+    if not all(isinstance(line, dict) for line in lines):
+        return api_error("Неверные данные")
+    items = []
+    for line in lines:
+        code = str(line.get("code") or "").strip()
+        if not code:
+            continue
+        try:
+            qty = int(line.get("quantity", 1))
+        except (TypeError, ValueError):
+            qty = 0
+        items.append((code, qty))
+    if not items:
+        return api_error("Не указан код")
+
+    conn = get_worker_db(username)
+    results = sell(username, conn, items)
+    conn.close()
+
+    out = []
+    for line in results:
+        product = line["product"]
+        remaining = None
+        if product is not None and not line["error"]:
+            # product прочитан под той же блокировкой, до списания
+            remaining = product["quantity"] - line["quantity"]
+        out.append({
+            "code": line["code"],
+            "quantity": line["quantity"],
+            "error": line["error"],
+            "product": product_json(product, remaining),
+        })
+
+    sold = sum(1 for line in out if not line["error"])
+    return jsonify({"sold": sold, "failed": len(out) - sold, "items": out})
+
+
+@app.route("/api/return", methods=["POST"])
+def api_return():
+    username = api_user()
+    if not username:
+        return api_error("Требуется вход", 401)
+
+    data = api_data()
+    if data is None:
+        return api_error("Неверные данные")
+    try:
+        sale_id = int(data.get("sale_id"))
+        qty = int(data.get("quantity", 0))
+    except (TypeError, ValueError):
+        return api_error("Неверные данные")
+
+    conn = get_worker_db(username)
+    sale, error = return_items(conn, sale_id, qty)
+    product = None
+    if sale is not None:
+        c = conn.cursor()
+        c.execute("SELECT * FROM products WHERE id=?", (sale["product_id"],))
+        product = c.fetchone()
+    conn.close()
+
+    if error:
+        return api_error(error, 404 if sale is None else 400)
+    return jsonify({"sale_id": sale_id, "quantity": qty, "product": product_json(product)})
+
+
+@app.route("/api/stock")
+def api_stock():
+    # ?code=... — остаток товара, ?category=... — остатки по размерам
+    username = api_user()
+    if not username:
+        return api_error("Требуется вход", 401)
 
     conn = get_worker_db(username)
     c = conn.cursor()
 
-    if request.method == "POST":
-        name = request.form.get("name")
-        description = request.form.get("description")
-        barcode = request.form.get("barcode")
-        qr_code = request.form.get("qr_code")
-        quantity = request.form.get("quantity")
-        size = request.form.get("size")
-        height = request.form.get("height")
+    code = request.args.get("code", "").strip()
+    if code:
+        # кэш сверяется с data_version, так что остаток всегда актуален
+        product = LOOKUP_CACHE.lookup(username, conn, code)
+        conn.close()
+        if product is None:
+            return api_error("Товар не найден", 404)
+        return jsonify({"code": code, "product": product_json(product)})
 
-        image_file = request.files.get("image")
-        image_name = None
+    category = request.args.get("category", "").strip()
+    if not category:
+        conn.close()
+        return api_error("Укажите code или category")
 
-        if image_file and image_file.filename:
-            image_name = secure_filename(image_file.filename)
-            image_file.save(os.path.join(UPLOAD_FOLDER, image_name))
+    c.execute("""
+        SELECT size, height, quantity, items FROM stock_by_size
+        WHERE category=? ORDER BY size, height
+    """, (category,))
+    rows = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return jsonify({"category": category, "stock": rows})
+
+
+# ================== IMPORT ==================
+# файл читается построчно и пишется пачками по IMPORT_CHUNK строк,
+# товар с тем же штрихкодом обновляется, новый — добавляется
+
+IMPORT_CHUNK = 2000
+IMPORT_MAX_ERRORS = 100
+IMPORT_FIELDS = ("name", "description", "barcode", "qr_code", "quantity", "category", "size", "height")
+IMPORT_HEADERS = {
+    "наименование": "name",
+    "название": "name",
+    "описание": "description",
+    "штрихкод": "barcode",
+    "qr": "qr_code",
+    "qr код": "qr_code",
+    "количество": "quantity",
+    "остаток": "quantity",
+    "категория": "category",
+    "размер": "size",
+    "рост": "height",
+}
+
+
+def _import_header(header):
+    fields = []
+    for title in header:
+        title = str(title or "").strip().lower()
+        fields.append(IMPORT_HEADERS.get(title, title))
+    return fields
+
+
+def _csv_rows(stream):
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    header_line = text.readline()
+    # Excel с русской локалью сохраняет CSV через ';'
+    delimiter = ";" if header_line.count(";") > header_line.count(",") else ","
+    header = _import_header(next(csv.reader([header_line], delimiter=delimiter)))
+    for values in csv.reader(text, delimiter=delimiter):
+        yield dict(zip(header, values))
+
+
+def _xlsx_rows(stream):
+    if openpyxl is None:
+        raise ValueError("Для XLSX нужен пакет openpyxl")
+    # read_only — лист читается потоком, без загрузки всей книги в память
+    try:
+        book = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, KeyError, OSError):
+        # .xlsx — zip-архив; другой файл с таким расширением сюда не дойдёт
+        raise ValueError("Файл не является книгой XLSX")
+    try:
+        rows = book.active.iter_rows(values_only=True)
+        header = _import_header(next(rows, ()))
+        for values in rows:
+            yield dict(zip(header, ("" if v is None else v for v in values)))
+    finally:
+        book.close()
+
+
+def read_import_rows(stream, filename):
+    if filename.lower().endswith(".xlsx"):
+        return _xlsx_rows(stream)
+    return _csv_rows(stream)
+
+
+def validate_import_row(raw, default_category):
+    row = {}
+    for field in IMPORT_FIELDS:
+        value = raw.get(field, "")
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        row[field] = str(value).strip() if value is not None else ""
+
+    if not row["name"]:
+        raise ValueError("нет наименования")
+    if not row["barcode"]:
+        raise ValueError("нет штрихкода")
+    try:
+        row["quantity"] = int(row["quantity"] or 0)
+    except ValueError:
+        raise ValueError(f"неверное количество: {row['quantity']}")
+    if row["quantity"] < 0:
+        raise ValueError("отрицательное количество")
+    # больше не влезет в INTEGER SQLite — упала бы вся пачка, а не строка
+    if row["quantity"] >= 2 ** 63:
+        raise ValueError(f"слишком большое количество: {row['quantity']}")
+    row["category"] = row["category"] or default_category
+    if row["category"] not in ("male", "female"):
+        raise ValueError(f"неизвестная категория: {row['category']}")
+    return row
+
+
+def _import_chunk(conn, chunk):
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        fields = [f for f in IMPORT_FIELDS if f != "barcode"]
+        barcodes = list(chunk)
+        existing = {}
+        for i in range(0, len(barcodes), 500):
+            part = barcodes[i:i + 500]
+            c.execute(f"""
+                SELECT barcode, {', '.join(fields)} FROM products
+                WHERE barcode IN ({','.join('?' * len(part))})
+            """, part)
+            for r in c.fetchall():
+                existing[r[0]] = tuple(r[1:])
+
+        # обновлёнными считаем только строки, где что-то поменялось
+        updates = [r for b, r in chunk.items()
+                   if b in existing and existing[b] != tuple(r[f] for f in fields)]
+        inserts = [r for b, r in chunk.items() if b not in existing]
+        last_id = c.execute("SELECT IFNULL(MAX(id), 0) FROM products").fetchone()[0]
+        # причина 'import' заодно выключает построчный триггер FTS на вставку
+        movement_reason(c, "import")
+
+        c.executemany("""
+            UPDATE products
+            SET name=:name, description=:description, qr_code=:qr_code, quantity=:quantity,
+                category=:category, size=:size, height=:height
+            WHERE barcode=:barcode
+        """, updates)
+        c.executemany("""
+            INSERT INTO products (name, description, barcode, qr_code, quantity, category, size, height)
+            VALUES (:name, :description, :barcode, :qr_code, :quantity, :category, :size, :height)
+        """, inserts)
+        if FTS5_AVAILABLE and inserts:
             c.execute("""
-                UPDATE products
-                SET name=?, description=?, barcode=?, qr_code=?, quantity=?, image=?
-                WHERE id=?
-            """, (name, description, barcode, qr_code, quantity, image_name, product_id))
+                INSERT INTO products_fts(rowid, name, description, barcode, qr_code)
+                SELECT id, name, description, barcode, qr_code FROM products WHERE id > ?
+            """, (last_id,))
+        movement_reason(c, None)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(inserts), len(updates)
+
+
+def import_products(conn, rows, default_category):
+    # генератор: после каждой пачки отдаёт текущий прогресс
+    progress = {"rows": 0, "inserted": 0, "updated": 0, "failed": 0, "errors": []}
+    chunk = {}
+
+    def flush():
+        inserted, updated = _import_chunk(conn, chunk)
+        progress["inserted"] += inserted
+        progress["updated"] += updated
+        chunk.clear()
+
+    # строка 1 — заголовок
+    for line_no, raw in enumerate(rows, start=2):
+        progress["rows"] += 1
+        try:
+            row = validate_import_row(raw, default_category)
+        except ValueError as e:
+            progress["failed"] += 1
+            if len(progress["errors"]) < IMPORT_MAX_ERRORS:
+                progress["errors"].append({"line": line_no, "error": str(e)})
+            continue
+
+        # повтор штрихкода в одной пачке — побеждает последняя строка
+        chunk[row["barcode"]] = row
+        if len(chunk) >= IMPORT_CHUNK:
+            flush()
+            yield progress
+
+    if chunk:
+        flush()
+    yield progress
+
+
+@app.route("/admin/user/<username>/<category>/import", methods=["POST"])
+def admin_import_products(username, category):
+    if session.get("type") != "admin":
+        return redirect("/")
+
+    upload = request.files.get("file")
+    if not upload or not upload.filename:
+        return jsonify({"error": "Файл не выбран"}), 400
+
+    # загрузка закрывается вместе с запросом, а ответ идёт потоком дольше —
+    # перекладываем её во временный файл (на диск, не в память)
+    filename = upload.filename
+    data = tempfile.TemporaryFile()
+    shutil.copyfileobj(upload.stream, data)
+    data.seek(0)
+
+    def generate():
+        conn = get_worker_db(username)
+        started = time.perf_counter()
+        try:
+            progress = None
+            for progress in import_products(conn, read_import_rows(data, filename), category):
+                yield json.dumps({k: v for k, v in progress.items() if k != "errors"}) + "\n"
+            if progress is not None:
+                progress["seconds"] = round(time.perf_counter() - started, 3)
+                progress["done"] = True
+                yield json.dumps(progress, ensure_ascii=False) + "\n"
+        except ValueError as e:
+            yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+        finally:
+            conn.close()
+            data.close()
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+@app.cli.command("import-products")
+@click.argument("username")
+@click.argument("path")
+@click.option("--category", default="male", help="Категория для строк без категории.")
+def import_products_command(username, path, category):
+    """Загрузить товары работнику из CSV или XLSX."""
+    conn = get_worker_db(username)
+    started = time.perf_counter()
+    progress = None
+    try:
+        with open(path, "rb") as f:
+            for progress in import_products(conn, read_import_rows(f, path), category):
+                print(f"rows: {progress['rows']}, inserted: {progress['inserted']}, "
+                      f"updated: {progress['updated']}, failed: {progress['failed']}")
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    finally:
+        conn.close()
+
+    if progress is None:
+        return
+    for err in progress["errors"]:
+        print(f"line {err['line']}: {err['error']}")
+    seconds = time.perf_counter() - started
+    print(f"{progress['rows']} rows in {seconds:.2f}s ({progress['rows'] / max(seconds, 1e-9):.0f} rows/s)")
+
+
+# ================== EXPORT ==================
+# выгрузка идёт потоком прямо из курсора: память не растёт с объёмом истории
+
+EXPORT_BATCH = 1000
+SALES_EXPORT_COLUMNS = ("id", "product_id", "name", "barcode", "quantity", "sale_time")
+STOCK_EXPORT_COLUMNS = ("id", "name", "description", "barcode", "qr_code", "quantity",
+                        "category", "size", "height")
+
+
+def owns_worker(admin, username):
+    # главный admin видит всех работников, остальные админы — только своих
+    conn = get_users_db()
+    c = conn.cursor()
+    if admin == "admin":
+        c.execute("SELECT 1 FROM users WHERE username=? AND type='worker'", (username,))
+    else:
+        c.execute("SELECT 1 FROM users WHERE username=? AND type='worker' AND owner_admin=?",
+                  (username, admin))
+    found = c.fetchone() is not None
+    conn.close()
+    return found
+
+
+def target_username():
+    # админ смотрит своего работника через ?user=, работник — только себя.
+    # чужое имя до базы не доходит: get_worker_db создал бы пустой файл
+    if session.get("type") == "admin":
+        username = request.args.get("user", "")
+        if not username:
+            abort(400)
+        if not owns_worker(session.get("user"), username):
+            abort(404)
+    else:
+        username = session["user"]
+    if not tenant_exists(username):
+        abort(404)
+    return username
+
+
+def encode_rows(batches, columns, fmt):
+    # batches — пачки кортежей; на выходе куски CSV или NDJSON
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        # BOM — чтобы Excel открыл кириллицу без вопросов
+        buf.write("\ufeff")
+        writer.writerow(columns)
+        yield buf.getvalue()
+
+    for rows in batches:
+        if fmt == "csv":
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows)
+            yield buf.getvalue()
         else:
-            c.execute("""
-                UPDATE products
-                SET name=?, description=?, barcode=?, qr_code=?, quantity=?
-                WHERE id=?
-            """, (name, description, barcode, qr_code, quantity, product_id))
+            yield "".join(json.dumps(dict(zip(columns, r)), ensure_ascii=False) + "\n" for r in rows)
 
-        conn.commit()
+
+def stream_rows(username, sql, params, columns, fmt):
+    conn = get_worker_db(username)
+    try:
+        c = conn.cursor()
+        c.row_factory = None
+        c.execute(sql, params)
+        yield from encode_rows(iter(lambda: c.fetchmany(EXPORT_BATCH), []), columns, fmt)
+    finally:
+        conn.close()
+
+
+def export_response(generator, name, fmt):
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    ext = "csv" if fmt == "csv" else "ndjson"
+    response = Response(generator, mimetype=mimetype)
+    # имя работника может быть кириллицей — по RFC 5987
+    response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(name)}.{ext}"
+    return response
+
+
+def parse_day(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return None
+
+
+@app.route("/export/sales")
+def export_sales():
+    if "user" not in session:
+        return redirect("/")
+
+    fmt = "ndjson" if request.args.get("format") == "ndjson" else "csv"
+    where = []
+    params = []
+
+    # sale_time хранится как 'YYYY-MM-DD HH:MM:SS' — строки сравниваются как даты
+    day_from = parse_day(request.args.get("from"))
+    if day_from:
+        where.append("sale_time >= ?")
+        params.append(day_from.strftime("%Y-%m-%d"))
+    day_to = parse_day(request.args.get("to"))
+    if day_to:
+        where.append("sale_time < ?")
+        params.append((day_to + timedelta(days=1)).strftime("%Y-%m-%d"))
+
+    sql = f"SELECT {', '.join(SALES_EXPORT_COLUMNS)} FROM sales_history"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY sale_time, id"
+
+    username = target_username()
+    return export_response(stream_rows(username, sql, params, SALES_EXPORT_COLUMNS, fmt),
+                           f"sales_{username}", fmt)
+
+
+@app.route("/export/stock")
+def export_stock():
+    if "user" not in session:
+        return redirect("/")
+
+    fmt = "ndjson" if request.args.get("format") == "ndjson" else "csv"
+    category = request.args.get("category")
+
+    # ?at=YYYY-MM-DD — остатки на конец того дня по журналу движений
+    day = parse_day(request.args.get("at"))
+    if day:
+        username = target_username()
+        conn = get_worker_db(username)
+        maybe_snapshot(conn)
+        c = conn.cursor()
+        c.row_factory = None
+        rows = stock_at(c, day.strftime("%Y-%m-%d 23:59:59"), category or None)
         conn.close()
+        return export_response(encode_rows([rows], STOCK_AT_COLUMNS, fmt),
+                               f"stock_{username}_{day:%Y-%m-%d}", fmt)
 
-        return redirect(request.referrer)
+    sql = f"SELECT {', '.join(STOCK_EXPORT_COLUMNS)} FROM products"
+    params = []
+    if category:
+        sql += " WHERE category=?"
+        params.append(category)
+    sql += " ORDER BY id"
 
-    c.execute("SELECT * FROM products WHERE id=?", (product_id,))
-    product = c.fetchone()
-    conn.close()
+    username = target_username()
+    return export_response(stream_rows(username, sql, params, STOCK_EXPORT_COLUMNS, fmt),
+                           f"stock_{username}", fmt)
 
-    return render_template("edit_product.html", product=product, user=username)
 
+# ================== STOCK LEDGER ==================
+# остаток на момент T = ближайший снимок не позже T + движения после него.
+# снимки делаются не чаще раза в STOCK_SNAPSHOT_HOURS, поэтому дельта
+# ограничена движениями за этот срок, а не всем журналом
 
-# ================== SALE ==================
+STOCK_SNAPSHOT_HOURS = float(os.environ.get("BRATEX_STOCK_SNAPSHOT_HOURS", "24"))
+# снимки моложе стольких дней храним все, старше — по первому за месяц
+STOCK_SNAPSHOT_KEEP_DAYS = int(os.environ.get("BRATEX_STOCK_SNAPSHOT_KEEP_DAYS", "90"))
+STOCK_AT_COLUMNS = ("product_id", "name", "barcode", "category", "size", "height", "quantity")
+MOVEMENT_COLUMNS = ("product_id", "name", "barcode", "opening", "sales", "returns",
+                    "imports", "adjustments", "closing")
+# причина в журнале -> колонка отчёта; create / edit / delete / initial — adjustments
+MOVEMENT_GROUPS = {"sale": "sales", "return": "returns", "import": "imports"}
 
-@app.route("/worker/sale", methods=["GET", "POST"])
-def worker_sale():
-    if "user" not in session or session.get("type") != "worker":
-        return redirect("/")
 
-    username = session["user"]
-    conn = get_worker_db(username)
+def ledger_position(c, when):
+    # последнее движение не позже when (по индексу moved_at)
+    c.execute("SELECT IFNULL(MAX(id), 0) FROM stock_movements WHERE moved_at <= ?", (when,))
+    return c.fetchone()[0]
+
+
+def stock_at(c, when, category=None):
+    c.execute("""
+        SELECT snapshot_at, movement_id FROM stock_snapshot_runs
+        WHERE snapshot_at <= ? ORDER BY snapshot_at DESC LIMIT 1
+    """, (when,))
+    run = c.fetchone()
+    snapshot_at, since = run if run else (None, 0)
+    until = max(ledger_position(c, when), since)
+
+    # товар, удалённый до when, даёт в сумме 0 и без строки в products — не показываем
+    c.execute("""
+        SELECT q.product_id, p.name, p.barcode, p.category, p.size, p.height, SUM(q.quantity)
+        FROM (
+            SELECT product_id, quantity FROM stock_snapshots WHERE snapshot_at = ?
+            UNION ALL
+            SELECT product_id, delta FROM stock_movements WHERE id > ? AND id <= ?
+        ) q
+        LEFT JOIN products p ON p.id = q.product_id
+        WHERE ? IS NULL OR p.category = ?
+        GROUP BY q.product_id
+        HAVING p.id IS NOT NULL OR SUM(q.quantity) != 0
+        ORDER BY q.product_id
+    """, (snapshot_at, since, until, category, category))
+    return c.fetchall()
+
+
+def movement_report(c, start, end):
+    # start / end — 'YYYY-MM-DD HH:MM:SS'; начало не включается, конец включается
+    opening = {r[0]: r for r in stock_at(c, start)}
+    close_id = ledger_position(c, end)
+    open_id = min(ledger_position(c, start), close_id)
+
+    c.execute("""
+        SELECT m.product_id, p.name, p.barcode, m.reason, SUM(m.delta)
+        FROM stock_movements m LEFT JOIN products p ON p.id = m.product_id
+        WHERE m.id > ? AND m.id <= ?
+        GROUP BY m.product_id, m.reason
+    """, (open_id, close_id))
+
+    report = {}
+    for product_id, row in opening.items():
+        report[product_id] = [product_id, row[1], row[2], row[6], 0, 0, 0, 0]
+    for product_id, name, barcode, reason, delta in c.fetchall():
+        line = report.setdefault(product_id, [product_id, name, barcode, 0, 0, 0, 0, 0])
+        column = MOVEMENT_COLUMNS.index(MOVEMENT_GROUPS.get(reason, "adjustments"))
+        line[column] += delta
+
+    rows = []
+    for product_id in sorted(report):
+        line = report[product_id]
+        rows.append(tuple(line) + (sum(line[3:8]),))
+    return rows
+
+
+def prune_stock_snapshots(c):
+    # остаток на любую дату всё равно считается от ближайшего снимка по журналу,
+    # так что старые дневные снимки только занимают место; внутри транзакции записи
+    border = (datetime.now() - timedelta(days=STOCK_SNAPSHOT_KEEP_DAYS)).strftime("%Y-%m-%d")
+    c.execute("""
+        SELECT snapshot_at FROM stock_snapshot_runs
+        WHERE snapshot_at < ? AND snapshot_at NOT IN (
+            SELECT MIN(snapshot_at) FROM stock_snapshot_runs GROUP BY substr(snapshot_at, 1, 7)
+        )
+    """, (border,))
+    old = [(r[0],) for r in c.fetchall()]
+    c.executemany("DELETE FROM stock_snapshots WHERE snapshot_at=?", old)
+    c.executemany("DELETE FROM stock_snapshot_runs WHERE snapshot_at=?", old)
+    return len(old)
+
+
+def maybe_snapshot(conn):
+    # новый снимок, если последний старше STOCK_SNAPSHOT_HOURS; вызывается из меню
+    # работника и отчётов, поэтому снимки идут и без cron
     c = conn.cursor()
+    border = (datetime.now() - timedelta(hours=STOCK_SNAPSHOT_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+    c.execute("SELECT MAX(snapshot_at) FROM stock_snapshot_runs")
+    last = c.fetchone()[0]
+    if last and last > border:
+        return None
+
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        # другой процесс мог успеть раньше
+        c.execute("SELECT MAX(snapshot_at) FROM stock_snapshot_runs")
+        last = c.fetchone()[0]
+        taken = None
+        if not last or last <= border:
+            taken = take_stock_snapshot(c)
+            prune_stock_snapshots(c)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return taken
 
-    error = None
-    success = None
 
-    found_product = None
-    code_value = ""
+@app.route("/export/movements")
+def export_movements():
+    if "user" not in session:
+        return redirect("/")
 
-    # PREVIEW по GET (после сканирования)
-    code_preview = request.args.get("code", "").strip()
-    if code_preview:
-        code_value = code_preview
-        c.execute("SELECT * FROM products WHERE barcode=? OR qr_code=?", (code_preview, code_preview))
-        found_product = c.fetchone()
+    fmt = "ndjson" if request.args.get("format") == "ndjson" else "csv"
+    day_to = parse_day(request.args.get("to")) or datetime.now()
+    day_from = parse_day(request.args.get("from")) or day_to - timedelta(days=29)
+    start = (day_from - timedelta(seconds=1)).strftime("%Y-%m-%d 23:59:59")
+    end = day_to.strftime("%Y-%m-%d 23:59:59")
 
-    # ПРОДАЖА только по кнопке
-    if request.method == "POST":
-        code = request.form.get("code", "").strip()
-        code_value = code
-        qty = int(request.form.get("quantity", 0))
+    username = target_username()
+    conn = get_worker_db(username)
+    maybe_snapshot(conn)
+    rows = movement_report(conn.cursor(), start, end)
+    conn.close()
 
-        c.execute("SELECT * FROM products WHERE barcode=? OR qr_code=?", (code, code))
-        product = c.fetchone()
+    return export_response(encode_rows([rows], MOVEMENT_COLUMNS, fmt),
+                           f"movements_{username}_{day_from:%Y-%m-%d}_{day_to:%Y-%m-%d}", fmt)
 
-        if not product:
-            error = "Товар не найден"
-        elif product["quantity"] < qty:
-            error = "Недостаточно товара на складе"
-        else:
-            new_qty = product["quantity"] - qty
-            c.execute("UPDATE products SET quantity=? WHERE id=?", (new_qty, product["id"]))
 
-            c.execute("""
-                INSERT INTO sales_history (product_id, name, barcode, quantity, sale_time)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                product["id"],
-                product["name"],
-                product["barcode"],
-                qty,
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            ))
+@app.cli.command("stock-snapshot")
+def stock_snapshot_command():
+    """Снять остатки всех работников (для cron)."""
+    for username in tenant_usernames():
+        conn = get_worker_db(username)
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        taken = take_stock_snapshot(c)
+        pruned = prune_stock_snapshots(c)
+        conn.commit()
+        conn.close()
+        print(f"{username}: {taken or 'skipped'}, pruned {pruned}")
 
-            conn.commit()
-            success = "Продажа выполнена"
 
-            # показать обновлённый остаток сразу после продажи
-            c.execute("SELECT * FROM products WHERE id=?", (product["id"],))
-            found_product = c.fetchone()
+# ================== ANALYTICS ==================
+# отчёты читают только сводные таблицы — время не зависит от длины истории
 
-    conn.close()
-    return render_template(
-        "sale.html",
-        error=error,
-        success=success,
-        found_product=found_product,
-        code_value=code_value
-    )
+ANALYTICS_TOP = 10
 
 
+def sales_report(c, days):
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
 
-# ================== SALES HISTORY ==================
+    c.execute("SELECT day, units, sales FROM sales_daily WHERE day >= ? ORDER BY day", (since,))
+    daily = [dict(r) for r in c.fetchall()]
 
-@app.route("/worker/sales_history")
-def sales_history():
-    if "user" not in session or session.get("type") != "worker":
-        return redirect("/")
+    weekly = {}
+    for d in daily:
+        year, week, _ = datetime.strptime(d["day"], "%Y-%m-%d").isocalendar()
+        key = f"{year}-W{week:02d}"
+        weekly[key] = weekly.get(key, 0) + d["units"]
 
-    username = session["user"]
-    conn = get_worker_db(username)
-    c = conn.cursor()
-    c.execute("SELECT * FROM sales_history ORDER BY id DESC")
-    history = c.fetchall()
-    conn.close()
+    # sell-through = продано / (продано + остаток) за период
+    c.execute("""
+        SELECT t.product_id, p.name, p.barcode, t.units, IFNULL(p.quantity, 0) AS stock
+        FROM (
+            SELECT product_id, SUM(units) AS units FROM sales_product_daily
+            WHERE day >= ? GROUP BY product_id
+        ) t
+        LEFT JOIN products p ON p.id = t.product_id
+        WHERE t.units > 0
+        ORDER BY t.units DESC
+        LIMIT ?
+    """, (since, ANALYTICS_TOP))
+    top = []
+    for r in c.fetchall():
+        row = dict(r)
+        total = row["units"] + max(row["stock"], 0)
+        row["sell_through"] = round(row["units"] / total, 3) if total else 0
+        top.append(row)
 
-    return render_template("sales_history.html", history=history)
+    c.execute("""
+        SELECT t.product_id, p.name, t.units, t.last_sale
+        FROM sales_product_total t LEFT JOIN products p ON p.id = t.product_id
+        WHERE t.units > 0
+        ORDER BY t.units DESC
+        LIMIT 50
+    """)
+    products = [dict(r) for r in c.fetchall()]
 
+    return {
+        "days": days,
+        "since": since,
+        "units": sum(d["units"] for d in daily),
+        "daily": daily,
+        "weekly": [{"week": k, "units": v} for k, v in sorted(weekly.items())],
+        "top": top,
+        "products": products,
+    }
 
-# ================== DELETE ==================
 
-@app.route("/delete_product/<username>/<int:product_id>/<category>")
-def delete_product(username, product_id, category):
+@app.route("/analytics")
+def analytics():
     if "user" not in session:
         return redirect("/")
 
+    days = max(1, min(request.args.get("days", 30, type=int), 366))
+    username = target_username()
     conn = get_worker_db(username)
-    c = conn.cursor()
-    c.execute("DELETE FROM products WHERE id=?", (product_id,))
-    conn.commit()
+    report = sales_report(conn.cursor(), days)
     conn.close()
 
-    if session.get("user") == "admin":
-        return redirect(f"/admin/user/{username}/{category}")
-    else:
-        return redirect(f"/worker/{category}")
+    if request.args.get("format") == "json":
+        return jsonify(report)
+    return render_template("analytics.html", report=report, user=username)
 
 
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Пересчитать сводки продаж по истории во всех базах работников."""
+    for username in tenant_usernames():
+        conn = get_worker_db(username)
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        rebuild_sales_rollups(c)
+        conn.commit()
+        conn.close()
+        print(f"{username}: ok")
+
+
+# ================== STOCK DASHBOARD ==================
+# сводные остатки по всем работникам админа: базы читаются параллельно,
+# а результат каждой кэшируется до изменения её data_version
+
+DASHBOARD_THREADS = int(os.environ.get("BRATEX_DASHBOARD_THREADS", "8"))
+DASHBOARD_TTL = 15
+DASHBOARD_LOW_STOCK = 2
+# порог «мало» из ?low= — в этих пределах, иначе каждый порог был бы своей записью кэша
+DASHBOARD_LOW_MAX = 100
+DASHBOARD_ROWS = 200
+DASHBOARD_CACHE_TENANTS = int(os.environ.get("BRATEX_DASHBOARD_CACHE_TENANTS", "256"))
+DASHBOARD_CACHE_VIEWS = 32
+
+
+class BoundedCache:
+    # LRU с ограничением размера и (необязательно) временем жизни записи
+
+    def __init__(self, max_items, ttl=None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if self.ttl is not None and time.monotonic() - item[0] >= self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+_dashboard_executor = ThreadPoolExecutor(max_workers=DASHBOARD_THREADS)
+_tenant_stock = BoundedCache(DASHBOARD_CACHE_TENANTS)
+_dashboard_cache = BoundedCache(DASHBOARD_CACHE_VIEWS, DASHBOARD_TTL)
+
+
+def tenant_stock(username):
+    # базу, которой нет среди открытых в пуле, после чтения закрываем:
+    # иначе сводка по сотне работников вытеснила бы из пула базы тех, кто продаёт
+    pooled = STORAGE == "shared" or DB_POOL.pooled(worker_db_path(username))
+    conn = get_worker_db(username)
+    try:
+        c = conn.cursor()
+        version = counter_version(c, "products")
+        cached = _tenant_stock.get(username)
+        if cached and cached[0] == version:
+            return cached[1]
 
-@app.route("/admin/create_admin", methods=["POST"])
-def create_admin():
-    if session.get("type") != "admin":
-        return redirect("/")
-
-    login = request.form.get("login","").strip()
-    password = request.form.get("password","").strip()
-    password2 = request.form.get("password2","").strip()
+        c.row_factory = None
+        c.execute("""
+            SELECT IFNULL(barcode, ''), MAX(name), IFNULL(size, ''), SUM(quantity)
+            FROM products GROUP BY IFNULL(barcode, ''), IFNULL(size, '')
+        """)
+        rows = c.fetchall()
+    finally:
+        if pooled:
+            conn.close()
+        else:
+            conn.close_for_real()
 
-    if not login or not password:
-        return redirect("/admin")
+    _tenant_stock.put(username, (version, rows))
+    return rows
 
-    if password != password2:
-        return redirect("/admin")
 
+def owned_workers(admin):
     conn = get_users_db()
     c = conn.cursor()
-    c.execute("INSERT INTO users (username, password, type) VALUES (?, ?, ?)", (login, password, "admin"))
-    conn.commit()
+    if admin == "admin":
+        c.execute("SELECT username FROM users WHERE type='worker'")
+    else:
+        c.execute("SELECT username FROM users WHERE type='worker' AND owner_admin=?", (admin,))
+    names = [r["username"] for r in c.fetchall()]
     conn.close()
-
-    return redirect("/admin")
-
-
-@app.route("/admin/admins")
-def admins_list():
+    # базы, которых ещё нет на диске, не создаём ради отчёта
+    return [n for n in names if tenant_exists(n)]
+
+
+def build_dashboard(admin, low):
+    workers = owned_workers(admin)
+    merged = {}
+    for username, rows in zip(workers, _dashboard_executor.map(tenant_stock, workers)):
+        for barcode, name, size, qty in rows:
+            item = merged.get((barcode, size))
+            if item is None:
+                item = merged[(barcode, size)] = {
+                    "barcode": barcode, "name": name, "size": size, "quantity": 0, "workers": {}
+                }
+            item["quantity"] += qty or 0
+            item["workers"][username] = qty or 0
+
+    items = sorted(merged.values(), key=lambda i: (-i["quantity"], i["barcode"]))
+    low_stock = sorted((i for i in items if i["quantity"] <= low), key=lambda i: (i["quantity"], i["barcode"]))
+    return {
+        "workers": workers,
+        "items": items,
+        "low_stock": low_stock,
+        "total_units": sum(i["quantity"] for i in items),
+        "built_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+@app.route("/admin/stock_dashboard")
+def stock_dashboard():
     if session.get("type") != "admin":
         return redirect("/")
 
-    conn = get_users_db()
-    c = conn.cursor()
-    c.execute("SELECT username, password FROM users WHERE type='admin' AND username != 'admin'")
-    admins = c.fetchall()
-    conn.close()
+    admin = session.get("user")
+    low = request.args.get("low", DASHBOARD_LOW_STOCK, type=int)
+    low = min(max(low, 0), DASHBOARD_LOW_MAX)
+    key = (admin, low)
 
-    return render_template("admins_list.html", admins=admins)
+    dashboard = _dashboard_cache.get(key)
+    if dashboard is None:
+        dashboard = build_dashboard(admin, low)
+        _dashboard_cache.put(key, dashboard)
 
+    if request.args.get("format") == "json":
+        return jsonify(dashboard)
+    return render_template("stock_dashboard.html", dashboard=dashboard, low=low, rows=DASHBOARD_ROWS)
 
 
+# ================== REORDER ==================
+# точки заказа и список «заканчивается». Продажи товара за последние
+# REORDER_WINDOW_DAYS дней копят триггеры (миграция m10) при каждой продаже
+# и возврате — историю для этого не читаем. Точка заказа — сколько уйдёт за
+# REORDER_LEAD_DAYS (срок поставки) при текущей скорости; товар в списке,
+# когда остаток не больше неё. Раз в день refresh_reorder сдвигает окно
 
-@app.route("/admin_workers_panel/create_worker", methods=["POST"])
-def create_worker_by_admin():
-    if "user" not in session:
-        return redirect("/")
+# зашиты в триггеры миграции — меняются только новой миграцией
+REORDER_WINDOW_DAYS = 28
+REORDER_LEAD_DAYS = 7
+# на сколько дней сверх срока поставки советуем дозаказать
+REORDER_COVER_DAYS = int(os.environ.get("BRATEX_REORDER_COVER_DAYS", "14"))
+REORDER_MENU_ROWS = 5
 
-    if session.get("type") != "admin":
-        return redirect("/")
 
-    # обычный админ создаёт работника
-    username = request.form.get("username")
-    password = request.form.get("password")
+def reorder_point_sql(sold):
+    # деление с округлением вверх: продали хоть штуку — точка заказа не ноль
+    return f"((MAX({sold}, 0) * {REORDER_LEAD_DAYS} + {REORDER_WINDOW_DAYS - 1}) / {REORDER_WINDOW_DAYS})"
 
-    if not username or not password:
-        return redirect("/admin_workers_panel")
 
-    conn = get_users_db()
+def reorder_window():
+    now = datetime.now()
+    return now.strftime("%Y-%m-%d"), (now - timedelta(days=REORDER_WINDOW_DAYS)).strftime("%Y-%m-%d")
+
+
+def refresh_reorder(conn):
+    # продажи, вышедшие из окна, перестают считаться; пересчитываются только
+    # строки, не обновлявшиеся сегодня, — по сводке продаж, не по истории
+    today, since = reorder_window()
     c = conn.cursor()
-    c.execute("INSERT INTO users (username, password, type, owner_admin) VALUES (?, ?, ?, ?)",
-              (username, password, "worker", session.get("user")))
-    conn.commit()
-    conn.close()
+    c.execute("SELECT 1 FROM stock_reorder WHERE window_day < ? LIMIT 1", (today,))
+    if not c.fetchone():
+        return False
 
-    init_worker_db(username)
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("""
+            UPDATE stock_reorder SET window_day = ?,
+                sold = IFNULL((SELECT SUM(units) FROM sales_product_daily d
+                               WHERE d.product_id = stock_reorder.product_id AND d.day > ?), 0)
+            WHERE window_day < ?
+        """, (today, since, today))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return True
 
-    return redirect("/admin_workers_panel")
 
+def low_stock(conn, category=None, limit=None):
+    refresh_reorder(conn)
+    c = conn.cursor()
+    sql = f"""
+        SELECT r.product_id, p.name, p.barcode, r.category, p.size, p.height,
+               r.quantity, r.sold, r.reorder_point,
+               MAX((r.sold * ? + {REORDER_WINDOW_DAYS - 1}) / {REORDER_WINDOW_DAYS} - r.quantity, 0) AS suggested
+        FROM stock_reorder r JOIN products p ON p.id = r.product_id
+        WHERE r.low = 1
+    """
+    params = [REORDER_LEAD_DAYS + REORDER_COVER_DAYS]
+    if category:
+        sql += " AND r.category = ?"
+        params.append(category)
+    sql += " ORDER BY r.quantity - r.reorder_point, p.name"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    c.execute(sql, params)
+
+    items = [dict(r) for r in c.fetchall()]
+    for item in items:
+        item["per_day"] = round(item["sold"] / REORDER_WINDOW_DAYS, 1)
+    return items
+
+
+def low_stock_count(conn):
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM stock_reorder WHERE low = 1")
+    return c.fetchone()[0]
 
-# ================== ADMIN WORKERS PANEL ==================
 
-@app.route("/admin_workers_panel")
-def admin_workers_panel():
+@app.route("/low_stock")
+def low_stock_page():
     if "user" not in session:
         return redirect("/")
 
-    if session.get("type") != "admin":
-        return redirect("/")
-
-    if session.get("user") == "admin":
-        return redirect("/admin")
+    username = target_username()
+    category = request.args.get("category") or None
 
-    # список работников (все кроме admin-аккаунтов)
-    conn = get_users_db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE type='worker' AND owner_admin=?", (session.get("user"),))
-    workers = c.fetchall()
+    conn = get_worker_db(username)
+    items = low_stock(conn, category)
     conn.close()
 
-    return render_template("admin_workers_panel.html", workers=workers)
-
-
+    if request.args.get("format") == "json":
+        return jsonify({"user": username, "category": category, "items": items})
+    return render_template("low_stock.html", items=items, user=username, category=category,
+                           lead_days=REORDER_LEAD_DAYS, cover_days=REORDER_COVER_DAYS)
 
-@app.route("/admin/delete_worker/<username>")
-def delete_worker(username):
-    if "user" not in session or session.get("type") != "admin":
-        return redirect("/")
 
+@app.cli.command("rebuild-reorder")
+def rebuild_reorder_command():
+    """Пересчитать точки заказа по сводке продаж во всех базах работников."""
+    for username in tenant_usernames():
+        conn = get_worker_db(username)
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        rebuild_stock_reorder(c)
+        conn.commit()
+        conn.close()
+        print(f"{username}: ok")
+
+
+# ================== MAINTENANCE ==================
+# обслуживание баз: статистика планировщика (ANALYZE, PRAGMA optimize),
+# incremental vacuum, сброс WAL (checkpoint TRUNCATE), снимок остатков и
+# сдвиг окна точек заказа.
+# Запускается командой flask maintenance или фоновым потоком
+# (BRATEX_MAINTENANCE=1). Поток есть в каждом процессе gunicorn, но работает
+# только владелец аренды в users.db. За шаг он берёт одну базу — ту, что
+# дольше всех ждёт, — и только если в неё не писали MAINTENANCE_QUIET_SECONDS:
+# пока работник продаёт, его базу не трогаем. Занятую базу отпускаем после
+# короткого busy timeout и пробуем на следующем шаге
+
+MAINTENANCE = os.environ.get("BRATEX_MAINTENANCE", "0") == "1"
+MAINTENANCE_STEP_SECONDS = float(os.environ.get("BRATEX_MAINTENANCE_STEP_SECONDS", "30"))
+# как часто обслуживать одну и ту же базу
+MAINTENANCE_EVERY_HOURS = float(os.environ.get("BRATEX_MAINTENANCE_EVERY_HOURS", "24"))
+MAINTENANCE_QUIET_SECONDS = float(os.environ.get("BRATEX_MAINTENANCE_QUIET_SECONDS", "120"))
+MAINTENANCE_BUSY_TIMEOUT = 0.5
+# ANALYZE читает не больше стольких строк на индекс — время не растёт с базой
+MAINTENANCE_ANALYSIS_LIMIT = 1000
+# incremental vacuum порциями, каждая в своей короткой транзакции
+MAINTENANCE_VACUUM_PAGES = 256
+MAINTENANCE_VACUUM_PAUSE = 0.05
+# файлы удалённых работников, в которые писали недавно, не переносим
+ORPHAN_GRACE_HOURS = 24
+ORPHANS_DIR = os.path.join(DATA_DIR, "orphans")
+
+
+def orphan_tenants():
+    # данные работников, которых больше нет в users
     conn = get_users_db()
     c = conn.cursor()
-    c.execute("DELETE FROM users WHERE username=? AND type='worker'", (username,))
-    conn.commit()
+    c.execute("SELECT username FROM users WHERE type='worker'")
+    workers = {r["username"] for r in c.fetchall()}
     conn.close()
-    return redirect("/admin_workers_panel")
 
+    if STORAGE == "shared":
+        if not os.path.exists(SHARED_DB):
+            return []
+        conn = DB_POOL.acquire(SHARED_DB)
+        ensure_schema(conn, SHARED_DB, SHARED_MIGRATIONS)
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT tenant_id FROM tenant_data_version ORDER BY tenant_id")
+        names = [r[0] for r in c.fetchall()]
+        conn.close()
+    else:
+        names = tenant_files()
+    return [n for n in names if n not in workers]
 
-@app.route("/admin/edit_worker/<username>", methods=["GET","POST"])
-def edit_worker(username):
-    if "user" not in session or session.get("type") != "admin":
-        return redirect("/")
 
-    conn = get_users_db()
-    c = conn.cursor()
+def maintenance_targets():
+    # (имя, путь, работники для снимка остатков)
+    targets = [("users.db", USERS_DB, [])]
+    if STORAGE == "shared":
+        if os.path.exists(SHARED_DB):
+            targets.append(("tenants.db", SHARED_DB, tenant_usernames()))
+        return targets
 
-    if request.method=="POST":
-        new_name=request.form.get("new_username")
-        new_pass=request.form.get("new_password")
-        if new_name:
-            c.execute("UPDATE users SET username=? WHERE username=?", (new_name, username))
-            username=new_name
-        if new_pass:
-            c.execute("UPDATE users SET password=? WHERE username=?", (new_pass, username))
-        conn.commit()
-        conn.close()
-        return redirect("/admin_workers_panel")
+    orphans = set(orphan_tenants())
+    for username in tenant_files():
+        if username not in orphans:
+            targets.append((f"{username}.db", worker_db_path(username), [username]))
+    return targets
 
-    c.execute("SELECT * FROM users WHERE username=?", (username,))
-    worker=c.fetchone()
-    conn.close()
-    return render_template("edit_worker.html", worker=worker)
 
+def due_databases(force=False):
+    conn = get_users_db()
+    c = conn.cursor()
+    c.execute("SELECT db_name, done_at FROM maintenance_runs")
+    done = {r["db_name"]: r["done_at"] for r in c.fetchall()}
+    conn.close()
 
+    border = (datetime.now() - timedelta(hours=MAINTENANCE_EVERY_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+    targets = [t for t in maintenance_targets() if force or done.get(t[0], "") <= border]
+    # сначала те, что не обслуживались дольше всех
+    targets.sort(key=lambda t: done.get(t[0], ""))
+    return targets
 
-@app.route("/size_table")
-def size_table():
-    if "user" not in session:
-        return redirect("/")
-    return render_template("size_table.html", title="Размеры")
 
+def recently_written(path):
+    # -wal меняется при каждой записи: смотрим mtime, не открывая базу
+    border = time.time() - MAINTENANCE_QUIET_SECONDS
+    for p in (path + "-wal", path):
+        try:
+            if os.path.getmtime(p) > border:
+                return True
+        except OSError:
+            pass
+    return False
 
 
-@app.route("/admin/size_manage")
-def admin_size_manage():
-    if "user" not in session:
-        return redirect("/")
-    if session.get("type") != "admin":
-        return redirect("/size_table")
-    return render_template("size_admin.html")
+def maintenance_connection(path):
+    # своё соединение в autocommit: каждая операция — отдельная короткая
+    # транзакция; mode=rw — пропавший файл не создаём заново
+    return sqlite3.connect(f"file:{quote(path)}?mode=rw", uri=True,
+                           timeout=MAINTENANCE_BUSY_TIMEOUT, isolation_level=None)
 
 
+def maintain_db(path, full_vacuum=False):
+    start = time.perf_counter()
+    conn = maintenance_connection(path)
+    try:
+        c = conn.cursor()
+        c.execute(f"PRAGMA analysis_limit={MAINTENANCE_ANALYSIS_LIMIT}")
+        c.execute("ANALYZE")
+        c.execute("PRAGMA optimize")
+
+        free_before = c.execute("PRAGMA freelist_count").fetchone()[0]
+        if full_vacuum:
+            # переводит старые файлы на incremental vacuum; база занята целиком
+            c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            c.execute("VACUUM")
+        elif c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            free = free_before
+            while free:
+                # execute делает один шаг pragma — одну страницу; executescript
+                # проходит всю порцию
+                conn.executescript(f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES})")
+                left = c.execute("PRAGMA freelist_count").fetchone()[0]
+                if left >= free:
+                    break
+                free = left
+                time.sleep(MAINTENANCE_VACUUM_PAUSE)
+        free_pages = c.execute("PRAGMA freelist_count").fetchone()[0]
+
+        # после TRUNCATE журнал пуст — размер берём до сброса
+        wal_size = os.path.getsize(path + "-wal") if os.path.exists(path + "-wal") else 0
+        busy = c.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+    finally:
+        conn.close()
 
+    return {
+        "ms": round((time.perf_counter() - start) * 1000, 1),
+        "wal_kb": wal_size // 1024,
+        "checkpoint_busy": bool(busy),
+        "freed_pages": max(free_before - free_pages, 0),
+        "free_pages": free_pages,
+    }
 
 
-@app.route("/worker/<category>/table")
-def worker_size_table(category):
-    if "user" not in session:
-        return redirect("/")
-    username = session["user"] if session.get("user") != "admin" else None
-    if session.get("type") == "admin":
-        username = request.args.get("user", "")
-    conn = get_worker_db(username)
+def record_maintenance(name, report):
+    conn = get_users_db()
     c = conn.cursor()
-    c.execute("CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY AUTOINCREMENT,name TEXT,description TEXT,barcode TEXT,qr_code TEXT,quantity INTEGER,size TEXT,height TEXT,image TEXT,category TEXT)")
+    c.execute("""
+        INSERT OR REPLACE INTO maintenance_runs (db_name, done_at, ms, wal_kb, freed_pages, free_pages)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), report["ms"],
+          report["wal_kb"], report["freed_pages"], report["free_pages"]))
     conn.commit()
-    c.execute("SELECT size, height, SUM(quantity) as qty FROM products WHERE category=? GROUP BY size, height", (category,))
-    rows = c.fetchall()
     conn.close()
-    data = {(r["size"], r["height"]): r["qty"] for r in rows}
-    title = "Мужские размеры" if category=="male" else "Женские размеры"
-    return render_template("size_table.html", title=title, data=data)
-
 
 
-
-# ================== RETURN SALE ==================
+def run_maintenance(force=False, limit=None, full_vacuum=False):
+    # обслужить базы, которым пора; фоновый шаг берёт одну (limit=1)
+    results = []
+    attempts = 0
+    for name, path, usernames in due_databases(force):
+        # users.db пишет сама аренда, продаж в нём нет
+        if not force and path != USERS_DB and recently_written(path):
+            results.append((name, {"skipped": "recent writes"}))
+            continue
+
+        attempts += 1
+        try:
+            report = maintain_db(path, full_vacuum)
+            for username in usernames:
+                conn = get_worker_db(username)
+                try:
+                    maybe_snapshot(conn)
+                    refresh_reorder(conn)
+                finally:
+                    conn.close()
+        except sqlite3.OperationalError as exc:
+            # база занята или пропала — уступаем, попробуем на следующем шаге
+            METRICS.inc("bratex_maintenance_total", (("result", "busy"),))
+            results.append((name, {"error": str(exc)}))
+        else:
+            record_maintenance(name, report)
+            METRICS.inc("bratex_maintenance_total", (("result", "ok"),))
+            results.append((name, report))
+
+        if limit and attempts >= limit:
+            break
+    return results
+
+
+def archive_orphans():
+    # базы удалённых работников переносим в orphans/<время>/ (только режим files)
+    border = time.time() - ORPHAN_GRACE_HOURS * 3600
+    target = os.path.join(ORPHANS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S"))
+    moved = []
+    for username in orphan_tenants():
+        path = worker_db_path(username)
+        if not os.path.exists(path) or os.path.getmtime(path) > border:
+            continue
+
+        # WAL — в основной файл, чтобы в архив попал один файл
+        conn = maintenance_connection(path)
+        try:
+            busy = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+        finally:
+            conn.close()
+        if busy:
+            continue
+
+        forget_db(path)
+        os.makedirs(target, exist_ok=True)
+        shutil.move(path, os.path.join(target, f"{username}.db"))
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        moved.append(username)
+    return moved
+
+
+def take_lease(owner, seconds):
+    # продлить свою аренду или забрать просроченную чужую
+    conn = get_users_db()
+    c = conn.cursor()
+    now = time.time()
+    try:
+        c.execute("""
+            INSERT INTO maintenance_lease (id, owner, expires_at) VALUES (1, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+            WHERE maintenance_lease.owner=excluded.owner OR maintenance_lease.expires_at < ?
+        """, (owner, now + seconds, now))
+        conn.commit()
+        c.execute("SELECT owner FROM maintenance_lease WHERE id=1")
+        return c.fetchone()["owner"] == owner
+    finally:
+        conn.close()
 
 
-@app.route("/worker/return_sale/<int:sale_id>", methods=["POST"])
-def return_sale(sale_id):
-    if "user" not in session or session.get("type") != "worker":
-        return redirect("/")
+def release_lease(owner):
+    conn = get_users_db()
+    conn.execute("DELETE FROM maintenance_lease WHERE owner=?", (owner,))
+    conn.commit()
+    conn.close()
 
-    username = session["user"]
-    conn = get_worker_db(username)
-    c = conn.cursor()
 
-    return_qty = int(request.form.get("return_qty", 0))
+class MaintenanceScheduler:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self.owner = None
+        self.leader = False
+        self.steps = 0
+        self.last = None
+        self.orphans = []
+        self._orphans_checked = None
+
+    def start(self):
+        # поток запускает первый запрос процесса — уже после fork gunicorn
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.owner = f"{self._pid}-{int(time.time())}"
+            self.leader = False
+            threading.Thread(target=self._run, name="maintenance", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(MAINTENANCE_STEP_SECONDS)
+            try:
+                self.step()
+            except Exception:
+                app.logger.exception("maintenance step failed")
+
+    def step(self):
+        # аренда живёт три шага: упавшего лидера сменит другой процесс
+        self.leader = take_lease(self.owner, MAINTENANCE_STEP_SECONDS * 3)
+        if not self.leader:
+            return
+
+        self.steps += 1
+        for name, report in run_maintenance(limit=1):
+            if "skipped" in report:
+                continue
+            self.last = dict(report, db=name, at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            app.logger.info("maintenance %s: %s", name, report)
+
+        now = time.monotonic()
+        if self._orphans_checked is None or now - self._orphans_checked > MAINTENANCE_EVERY_HOURS * 3600:
+            self._orphans_checked = now
+            self.orphans = orphan_tenants()
+            if self.orphans:
+                app.logger.warning("databases of deleted workers: %s (flask maintenance --archive-orphans)",
+                                   ", ".join(self.orphans))
+
+    def stats(self):
+        return {
+            "enabled": MAINTENANCE,
+            "leader": self.leader,
+            "steps": self.steps,
+            "last": self.last,
+            "orphans": self.orphans,
+        }
+
+
+SCHEDULER = MaintenanceScheduler()
+
+
+@app.before_request
+def start_maintenance():
+    if MAINTENANCE:
+        SCHEDULER.start()
+
+
+@app.cli.command("maintenance")
+@click.option("--force", is_flag=True, help="Все базы сразу, без расписания и паузы после записи.")
+@click.option("--vacuum", is_flag=True, help="Полный VACUUM: переводит старые базы на incremental vacuum.")
+@click.option("--archive-orphans", "archive", is_flag=True, help="Перенести базы удалённых работников в orphans/.")
+def maintenance_command(force, vacuum, archive):
+    """Обслужить базы: статистика, WAL, vacuum, базы удалённых работников."""
+    owner = f"cli-{os.getpid()}"
+    if not take_lease(owner, 3600):
+        print("maintenance is already running in another process")
+        return
+
+    try:
+        for name, report in run_maintenance(force=force, full_vacuum=vacuum):
+            if "skipped" in report:
+                print(f"{name}: skipped ({report['skipped']})")
+            elif "error" in report:
+                print(f"{name}: {report['error']}")
+            else:
+                print(f"{name}: {report['ms']} ms, wal {report['wal_kb']} KB, "
+                      f"freed {report['freed_pages']}, free {report['free_pages']}"
+                      + (", checkpoint busy" if report["checkpoint_busy"] else ""))
+
+        orphans = orphan_tenants()
+        if archive and STORAGE == "shared":
+            print("shared storage: orphaned rows are reported, not moved")
+        elif archive:
+            moved = archive_orphans()
+            print(f"orphans archived: {', '.join(moved) or 'none'}")
+            orphans = [n for n in orphans if n not in moved]
+        if orphans:
+            print(f"orphans: {', '.join(orphans)}")
+    finally:
+        release_lease(owner)
+
+
+# ================== BACKUP ==================
+# flask backup — копия users.db и всех баз работников на ходу, через
+# sqlite3 backup API. Копирование идёт порциями BACKUP_PAGES страниц внутри
+# одной читающей транзакции: в WAL она не мешает продажам, а копия
+# соответствует моменту её начала и не начинается заново от каждой записи.
+# Базы, у которых data_version не изменилась с прошлого архива, не копируются —
+# манифест ссылается на архив, где лежит их последняя копия. Архив —
+# bratex-<время>.tar: <база>.gz и manifest.json с sha256 каждой базы
+
+BACKUP_DIR = os.environ.get("BRATEX_BACKUP_DIR", os.path.join(DATA_DIR, "backups"))
+BACKUP_THREADS = int(os.environ.get("BRATEX_BACKUP_THREADS", "4"))
+# сколько последних архивов хранить (и всё, на что они ссылаются); 0 — все
+BACKUP_KEEP = int(os.environ.get("BRATEX_BACKUP_KEEP", "14"))
+BACKUP_PAGES = 1024
+BACKUP_CHUNK = 1024 * 1024
+
+
+def backup_targets():
+    targets = [USERS_DB]
+    if STORAGE == "shared":
+        if os.path.exists(SHARED_DB):
+            targets.append(SHARED_DB)
+    else:
+        targets.extend(worker_db_path(username) for username in tenant_files())
+    return targets
+
+
+def backup_archives():
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted(os.path.join(BACKUP_DIR, f) for f in os.listdir(BACKUP_DIR)
+                  if f.startswith("bratex-") and f.endswith(".tar"))
+
+
+def read_manifest(archive):
+    with tarfile.open(archive) as tar:
+        return json.load(tar.extractfile("manifest.json"))
+
+
+def backup_fingerprint(c, path):
+    # users.db копируем всегда — он маленький и счётчика изменений у него нет
+    if path == USERS_DB:
+        return None
+    prefix = "tenant_" if path == SHARED_DB else ""
+    h = hashlib.sha256()
+    try:
+        h.update(str(c.execute("PRAGMA user_version").fetchone()[0]).encode())
+        # товары и продажи считает data_version, снимки остатков — отдельно
+        for table in ("data_version", "stock_snapshot_runs"):
+            for row in c.execute(f"SELECT * FROM {prefix}{table} ORDER BY 1, 2"):
+                h.update(repr(tuple(row)).encode())
+    except sqlite3.OperationalError:
+        # база ещё без миграций — считаем изменённой
+        return None
+    return h.hexdigest()
+
+
+def backup_db(path, previous, workdir):
+    # (fingerprint, None) если база не менялась, иначе (fingerprint, копия)
+    src = maintenance_connection(path)
+    try:
+        src.execute("BEGIN")
+        fingerprint = backup_fingerprint(src, path)
+        if fingerprint is not None and fingerprint == previous:
+            return fingerprint, None
+
+        name = os.path.basename(path)
+        copy_path = os.path.join(workdir, name)
+        dst = sqlite3.connect(copy_path)
+        try:
+            src.backup(dst, pages=BACKUP_PAGES)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+    # сжимаем и заодно считаем контрольную сумму несжатой копии
+    h = hashlib.sha256()
+    size = 0
+    with open(copy_path, "rb") as f, gzip.open(copy_path + ".gz", "wb", compresslevel=6) as out:
+        for chunk in iter(lambda: f.read(BACKUP_CHUNK), b""):
+            h.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    os.remove(copy_path)
+    return fingerprint, {"file": copy_path + ".gz", "sha256": h.hexdigest(), "size": size}
+
+
+def run_backup(full=False):
+    previous = {}
+    archives = backup_archives()
+    if archives and not full:
+        previous = {e["name"]: e for e in read_manifest(archives[-1])["databases"]}
+
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    # микросекунды: два запуска в одну секунду (cron + вручную) не столкнутся,
+    # а имена по-прежнему сортируются по времени
+    archive_name = f"bratex-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.tar"
+    archive = os.path.join(BACKUP_DIR, archive_name)
+    if os.path.exists(archive):
+        # на этот архив могут ссылаться следующие — не перезаписываем
+        raise click.ClickException(f"{archive_name} already exists")
+    workdir = tempfile.mkdtemp(dir=BACKUP_DIR)
+    entries = []
+
+    try:
+        targets = backup_targets()
+        with ThreadPoolExecutor(max_workers=BACKUP_THREADS) as executor:
+            futures = [
+                executor.submit(backup_db, path,
+                                previous.get(os.path.basename(path), {}).get("fingerprint"), workdir)
+                for path in targets
+            ]
+            with tarfile.open(archive + ".tmp", "w") as tar:
+                for path, future in zip(targets, futures):
+                    name = os.path.basename(path)
+                    fingerprint, copy = future.result()
+                    if copy is None:
+                        # не изменилась — ссылка на архив с последней копией
+                        entry = dict(previous[name])
+                        entry["copied"] = False
+                    else:
+                        tar.add(copy["file"], arcname=f"{name}.gz")
+                        gz_size = os.path.getsize(copy["file"])
+                        os.remove(copy["file"])
+                        entry = {
+                            "name": name,
+                            "archive": archive_name,
+                            "fingerprint": fingerprint,
+                            "sha256": copy["sha256"],
+                            "size": copy["size"],
+                            "gz_size": gz_size,
+                            "copied": True,
+                        }
+                    entries.append(entry)
+
+                manifest = json.dumps({
+                    "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "storage": STORAGE,
+                    "databases": entries,
+                }, ensure_ascii=False, indent=1).encode()
+                info = tarfile.TarInfo("manifest.json")
+                info.size = len(manifest)
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(manifest))
+        os.replace(archive + ".tmp", archive)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if os.path.exists(archive + ".tmp"):
+            os.remove(archive + ".tmp")
+    return archive, entries
+
+
+def prune_backups(keep):
+    # старый архив удаляем, только если на него не ссылается ни один из keep последних
+    archives = backup_archives()
+    if keep <= 0 or len(archives) <= keep:
+        return []
+    needed = set()
+    for archive in archives[-keep:]:
+        needed.update(e["archive"] for e in read_manifest(archive)["databases"])
+    removed = []
+    for archive in archives[:-keep]:
+        if os.path.basename(archive) not in needed:
+            os.remove(archive)
+            removed.append(os.path.basename(archive))
+    return removed
+
+
+def extract_db(archive_dir, entry, target):
+    # распаковать копию в target и сверить sha256; False — архив повреждён
+    h = hashlib.sha256()
+    with tarfile.open(os.path.join(archive_dir, entry["archive"])) as tar:
+        member = tar.extractfile(f"{entry['name']}.gz")
+        with gzip.open(member) as f, open(target, "wb") as out:
+            for chunk in iter(lambda: f.read(BACKUP_CHUNK), b""):
+                h.update(chunk)
+                out.write(chunk)
+    return h.hexdigest() == entry["sha256"]
+
+
+@app.cli.command("backup")
+@click.option("--full", is_flag=True, help="Скопировать все базы, даже не изменившиеся.")
+def backup_command(full):
+    """Архив всех баз без остановки приложения."""
+    started = time.perf_counter()
+    archive, entries = run_backup(full)
+    for e in entries:
+        if e["copied"]:
+            print(f"{e['name']}: {e['size'] / 1024:.1f} KB -> {e['gz_size'] / 1024:.1f} KB")
+        else:
+            print(f"{e['name']}: unchanged, in {e['archive']}")
+    copied = sum(1 for e in entries if e["copied"])
+    print(f"{os.path.basename(archive)}: {copied} copied, {len(entries) - copied} unchanged, "
+          f"{time.perf_counter() - started:.2f}s")
+    for name in prune_backups(BACKUP_KEEP):
+        print(f"removed {name}")
+
+
+@app.cli.command("restore")
+@click.argument("archive")
+@click.option("--only", multiple=True, help="Только эти базы, например --only w1.db.")
+@click.option("--check", is_flag=True, help="Только проверить контрольные суммы.")
+@click.option("--force", is_flag=True, help="Заменить существующие файлы.")
+def restore_command(archive, only, check, force):
+    """Восстановить базы из архива flask backup (приложение должно быть остановлено)."""
+    archive_dir = os.path.dirname(os.path.abspath(archive))
+    failed = False
+    for entry in read_manifest(archive)["databases"]:
+        name = entry["name"]
+        if only and name not in only:
+            continue
+        if os.path.basename(name) != name:
+            print(f"{name}: bad name, skipped")
+            failed = True
+            continue
+
+        path = os.path.join(DATA_DIR, name)
+        if not check and os.path.exists(path) and not force:
+            print(f"{name}: exists, skipped (use --force)")
+            continue
+
+        fd, tmp = tempfile.mkstemp(dir=DATA_DIR, suffix=".restore")
+        os.close(fd)
+        try:
+            if not extract_db(archive_dir, entry, tmp):
+                print(f"{name}: checksum mismatch")
+                failed = True
+                continue
+            if check:
+                print(f"{name}: ok")
+                continue
+
+            forget_db(path)
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            os.replace(tmp, path)
+            print(f"{name}: restored from {entry['archive']}")
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    if failed:
+        raise SystemExit(1)
+
+
+# ================== METRICS ==================
+# время роутов и SQL в формате Prometheus. У каждого процесса gunicorn свои
+# счётчики; раз в METRICS_FLUSH_SECONDS он пишет их в METRICS_DIR/<pid>-<старт>.json,
+# а /metrics складывает файлы всех процессов — отвечать может любой воркер.
+# Файлы завершившихся процессов новый процесс при старте сворачивает в
+# aggregate.json: счётчики не уменьшаются, а файлов не становится всё больше
+
+METRICS_DIR = os.environ.get("BRATEX_METRICS_DIR", os.path.join(DATA_DIR, "metrics"))
+METRICS_FLUSH_SECONDS = float(os.environ.get("BRATEX_METRICS_FLUSH_SECONDS", "1"))
+METRICS_TOKEN = os.environ.get("BRATEX_METRICS_TOKEN")
+METRICS_AGGREGATE = "aggregate.json"
+METRICS_LOCK = "aggregate.lock"
+SLOW_QUERY_MS = float(os.environ.get("BRATEX_SLOW_QUERY_MS", "100"))
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SQL_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+METRICS_BUCKETS = {
+    "bratex_sql_query_duration_seconds": SQL_BUCKETS,
+    "bratex_group_commit_batch_size": BATCH_BUCKETS,
+    "bratex_group_commit_seconds": SQL_BUCKETS,
+}
+
+METRICS_HELP = {
+    "bratex_http_requests_total": ("counter", "HTTP-запросы по роуту, методу и статусу"),
+    "bratex_http_request_duration_seconds": ("histogram", "Время обработки запроса"),
+    "bratex_http_sql_queries_total": ("counter", "SQL-запросы, сделанные роутом"),
+    "bratex_sql_query_duration_seconds": ("histogram", "Время SQL-запроса по типу базы"),
+    "bratex_sql_slow_queries_total": ("counter", f"SQL-запросы дольше {SLOW_QUERY_MS:g} мс"),
+    "bratex_db_pool_events_total": ("counter", "События пула соединений"),
+    "bratex_lookup_cache_events_total": ("counter", "События кэша поиска по коду"),
+    "bratex_group_commit_batch_size": ("histogram", "Продаж в одном групповом коммите"),
+    "bratex_group_commit_seconds": ("histogram", "Время транзакции группового коммита"),
+    "bratex_maintenance_total": ("counter", "Обслуживание баз: ok или база занята"),
+}
+
+
+def db_kind(path):
+    # тип базы, а не имя файла: работников сотни, метрик должно быть немного
+    if path == USERS_DB:
+        return "users"
+    if path == SHARED_DB:
+        return "shared"
+    return "worker"
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._started = int(time.time())
+        self._flushed = 0.0
+        self._folded = False
+        self.counters = {}
+        self.histograms = {}
+
+    def _check_fork(self):
+        # после fork (gunicorn --preload) счётчики родителя не наследуем
+        if self._pid != os.getpid():
+            self._reset()
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self._check_fork()
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, labels)
+        with self._lock:
+            self._check_fork()
+            h = self.histograms.get(key)
+            if h is None:
+                # счётчики корзин, затем sum и count
+                h = self.histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            self._check_fork()
+            counters = [[name, list(labels), value] for (name, labels), value in self.counters.items()]
+            histograms = [[name, list(labels), list(h)] for (name, labels), h in self.histograms.items()]
+
+        pool = DB_POOL.stats()
+        for event in ("hits", "misses", "evictions"):
+            counters.append(["bratex_db_pool_events_total", [["event", event]], pool[event]])
+        cache = LOOKUP_CACHE.stats()
+        for event in ("hits", "misses", "invalidations"):
+            counters.append(["bratex_lookup_cache_events_total", [["event", event]], cache[event]])
+
+        return {"counters": counters, "histograms": histograms}
+
+    def path(self):
+        return os.path.join(METRICS_DIR, f"{self._pid}-{self._started}.json")
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._flushed < METRICS_FLUSH_SECONDS:
+            return
+        self._flushed = now
+
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        if not self._folded:
+            self._folded = True
+            fold_dead_metrics(self._pid, self._started)
+        write_metrics_file(self.path(), self.snapshot())
+
+
+def write_metrics_file(path, data):
+    # пишем во временный файл и подменяем: читатель не увидит половину
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def read_metrics_file(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def merge_metrics(counters, histograms, data):
+    for name, labels, value in data["counters"]:
+        key = (name, tuple(tuple(l) for l in labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, h in data["histograms"]:
+        key = (name, tuple(tuple(l) for l in labels))
+        total = histograms.get(key)
+        histograms[key] = h if total is None else [a + b for a, b in zip(total, h)]
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def fold_dead_metrics(my_pid, my_started):
+    # файлы завершившихся процессов -> aggregate.json. Под flock: процессы
+    # gunicorn стартуют разом, и без блокировки файл сложился бы дважды
+    if fcntl is None:
+        return
+    with open(os.path.join(METRICS_DIR, METRICS_LOCK), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        dead = []
+        for fname in os.listdir(METRICS_DIR):
+            match = re.fullmatch(r"(\d+)-(\d+)\.json", fname)
+            if not match:
+                continue
+            pid, started = int(match.group(1)), int(match.group(2))
+            # pid мог достаться нам от давно завершившегося процесса
+            if pid == my_pid and started != my_started or pid != my_pid and not process_alive(pid):
+                dead.append(fname)
+        if not dead:
+            return
+
+        counters = {}
+        histograms = {}
+        aggregate = os.path.join(METRICS_DIR, METRICS_AGGREGATE)
+        for fname in [METRICS_AGGREGATE] + dead:
+            data = read_metrics_file(os.path.join(METRICS_DIR, fname))
+            if data:
+                merge_metrics(counters, histograms, data)
+        write_metrics_file(aggregate, {
+            "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+            "histograms": [[name, list(labels), h] for (name, labels), h in histograms.items()],
+        })
+        for fname in dead:
+            os.remove(os.path.join(METRICS_DIR, fname))
+
+
+METRICS = Metrics()
+
+
+def record_query(conn, sql, seconds, batch=False):
+    kind = getattr(conn, "db_kind", "other")
+    METRICS.observe("bratex_sql_query_duration_seconds", (("db", kind),), seconds, SQL_BUCKETS)
+
+    if has_request_context():
+        g.sql_queries = g.get("sql_queries", 0) + 1
+
+    # executemany — пачка строк (импорт, групповой коммит): её время растёт
+    # с размером пачки, медленным запросом она не считается
+    if not batch and seconds * 1000 >= SLOW_QUERY_MS:
+        METRICS.inc("bratex_sql_slow_queries_total", (("db", kind),))
+        app.logger.warning("slow query %.1f ms [%s]: %s", seconds * 1000, kind, " ".join(sql.split())[:500])
+
+
+def record_request(status):
+    if g.get("request_start") is None:
+        return
+    seconds = time.perf_counter() - g.request_start
+    g.request_start = None
+
+    endpoint = request.endpoint or "not_found"
+    METRICS.inc("bratex_http_requests_total",
+                (("endpoint", endpoint), ("method", request.method), ("status", str(status))))
+    METRICS.observe("bratex_http_request_duration_seconds", (("endpoint", endpoint),), seconds, HTTP_BUCKETS)
+    METRICS.inc("bratex_http_sql_queries_total", (("endpoint", endpoint),), g.get("sql_queries", 0))
+    METRICS.flush()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def stop_request_timer(response):
+    record_request(response.status_code)
+    return response
+
+
+@app.teardown_request
+def fail_request_timer(exc):
+    # after_request не вызывается, если роут упал с исключением
+    if exc is not None:
+        record_request(500)
+
+
+def collect_metrics():
+    METRICS.flush(force=True)
+    counters = {}
+    histograms = {}
+
+    # читаем под общей блокировкой: иначе сворачиваемый файл попал бы
+    # в сумму дважды — сам и в aggregate.json
+    with open(os.path.join(METRICS_DIR, METRICS_LOCK), "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        for fname in os.listdir(METRICS_DIR):
+            if not fname.endswith(".json"):
+                continue
+            data = read_metrics_file(os.path.join(METRICS_DIR, fname))
+            if data:
+                merge_metrics(counters, histograms, data)
+
+    return counters, histograms
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def render_metrics(counters, histograms):
+    lines = []
+    seen = set()
 
-    c.execute("SELECT * FROM sales_history WHERE id=?", (sale_id,))
-    sale = c.fetchone()
+    def header(name):
+        if name not in seen:
+            seen.add(name)
+            kind, text = METRICS_HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
 
-    if sale and return_qty > 0 and return_qty <= sale["quantity"]:
-        c.execute("SELECT * FROM products WHERE id=?", (sale["product_id"],))
-        product = c.fetchone()
+    for (name, labels), value in sorted(counters.items()):
+        header(name)
+        lines.append(f"{name}{format_labels(labels)} {value}")
 
-        if product:
-            new_qty = product["quantity"] + return_qty
-            c.execute("UPDATE products SET quantity=? WHERE id=?", (new_qty, product["id"]))
+    for (name, labels), h in sorted(histograms.items()):
+        header(name)
+        buckets = METRICS_BUCKETS.get(name, HTTP_BUCKETS)
+        for bound, count in zip(buckets, h):
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {count}")
+        lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {h[-1]}")
+        lines.append(f"{name}_sum{format_labels(labels)} {h[-2]:.6f}")
+        lines.append(f"{name}_count{format_labels(labels)} {h[-1]}")
 
-        # если вернули полностью — удаляем продажу
-        if return_qty == sale["quantity"]:
-            c.execute("DELETE FROM sales_history WHERE id=?", (sale_id,))
-        else:
-            # если частично — уменьшаем количество в истории
-            remaining = sale["quantity"] - return_qty
-            c.execute("UPDATE sales_history SET quantity=? WHERE id=?", (remaining, sale_id))
+    return "\n".join(lines) + "\n"
 
-        conn.commit()
 
-    conn.close()
-    return redirect("/worker/sales_history")
+@app.route("/metrics")
+def metrics():
+    # BRATEX_METRICS_TOKEN задан — нужен "Authorization: Bearer <token>"
+    if METRICS_TOKEN and request.headers.get("Authorization", "") != f"Bearer {METRICS_TOKEN}":
+        return Response("unauthorized\n", status=401, mimetype="text/plain")
 
+    counters, histograms = collect_metrics()
+    return Response(render_metrics(counters, histograms),
+                    mimetype="text/plain; version=0.0.4; charset=utf-8")
 
 
+# ================== DB STATS ==================
 
-@app.route("/admin/change_admin_password/<username>", methods=["POST"])
-def change_admin_password(username):
-    if session.get("user") != "admin":
+@app.route("/admin/db_stats")
+def db_stats():
+    if session.get("type") != "admin":
         return redirect("/")
 
-    new_pass = request.form.get("new_password","").strip()
-    if not new_pass:
-        return redirect("/admin/admins")
+    return jsonify({
+        "startup_ms": STARTUP_MS,
+        "ready_dbs": len(_ready_dbs),
+        "pool": DB_POOL.stats(),
+        "lookup_cache": LOOKUP_CACHE.stats(),
+        "group_commit": SALE_JOURNAL.stats(),
+        "maintenance": SCHEDULER.stats(),
+    })
 
-    conn = get_users_db()
-    c = conn.cursor()
-    c.execute("UPDATE users SET password=? WHERE username=? AND type='admin'", (new_pass, username))
-    conn.commit()
-    conn.close()
 
-    return redirect("/admin/admins")
+# время импорта модуля = время старта воркера gunicorn
+STARTUP_MS = round((time.perf_counter() - STARTUP_BEGIN) * 1000, 1)
+app.logger.info("bratex startup: %.1f ms", STARTUP_MS)
 
 
 # ================== RUN ==================
 
 if __name__ == "__main__":
     app.run()
-
-
-
@@ -0,0 +1,387 @@
+# Нагрузочный бенчмарк горячих роутов.
+#
+#   python bench.py                                  # тестовый клиент Flask
+#   python bench.py --target gunicorn --workers 2    # живой gunicorn на 127.0.0.1
+#   python bench.py --out before.json
+#   python bench.py --out after.json --compare before.json
+#
+# Данные — синтетические работники во временной папке (BRATEX_DATA_DIR),
+# рабочие базы не трогаются. При одинаковом --seed наборы данных и
+# последовательность запросов совпадают между запусками.
+
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PASSWORD = "bench"
+CATEGORIES = ("male", "female")
+SIZES = [str(s) for s in range(40, 82, 2)]
+HEIGHTS = ["152", "158", "164", "170", "176", "182", "188", "194", "200"]
+ITEMS = ["Рубашка", "Брюки", "Куртка", "Платье", "Пиджак", "Жилет", "Юбка", "Пальто", "Свитер", "Костюм"]
+COLORS = ["синий", "чёрный", "белый", "серый", "зелёный", "бежевый", "красный"]
+
+SCENARIOS = ("login", "sale_preview", "sale", "search", "sales_history", "size_table")
+
+
+# ================== SEED ==================
+
+def seed_data(bratex, tenants, products, sales, seed):
+    rng = random.Random(seed)
+    now = datetime(2026, 1, 1)
+    catalog = {}
+
+    conn = bratex.get_users_db()
+    c = conn.cursor()
+    for t in range(tenants):
+        c.execute("INSERT OR IGNORE INTO users (username, password, type) VALUES (?, ?, 'worker')",
+                  (f"bench{t}", PASSWORD))
+    conn.commit()
+    conn.close()
+
+    for t in range(tenants):
+        username = f"bench{t}"
+        rows = []
+        for i in range(products):
+            name = f"{rng.choice(ITEMS)} {rng.choice(COLORS)} {i}"
+            rows.append((name, f"Артикул {i}", f"{t:03d}{i:09d}", f"Q{t:03d}{i:09d}",
+                         1000000, rng.choice(CATEGORIES), rng.choice(SIZES), rng.choice(HEIGHTS)))
+
+        conn = bratex.get_worker_db(username)
+        c = conn.cursor()
+        c.execute("BEGIN")
+        c.executemany("""
+            INSERT INTO products (name, description, barcode, qr_code, quantity, category, size, height)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        # id читаем обратно: в общей базе они сквозные и у работника начинаются не с 1,
+        # а lastrowid / RETURNING представления их не видят
+        c.execute("SELECT barcode, id FROM products")
+        ids = dict(c.fetchall())
+        history = []
+        for _ in range(sales):
+            i = rng.randrange(products)
+            sale_time = now - timedelta(seconds=rng.randrange(365 * 24 * 3600))
+            history.append((ids[rows[i][2]], rows[i][0], rows[i][2], rng.randint(1, 3),
+                            sale_time.strftime("%Y-%m-%d %H:%M:%S")))
+        history.sort(key=lambda r: r[4])
+        c.executemany("""
+            INSERT INTO sales_history (product_id, name, barcode, quantity, sale_time)
+            VALUES (?, ?, ?, ?, ?)
+        """, history)
+        conn.commit()
+        c.execute("ANALYZE")
+        conn.close()
+
+        catalog[username] = [r[2] for r in rows]
+
+    return catalog
+
+
+# ================== DRIVERS ==================
+
+class ClientDriver:
+    # тестовый клиент Flask: без сети, меряем только приложение
+
+    def __init__(self, bratex):
+        self.client = bratex.app.test_client()
+
+    def get(self, path):
+        return self.client.get(path).status_code
+
+    def post(self, path, data):
+        return self.client.post(path, data=data).status_code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpDriver:
+    # отдельная cookie-сессия на каждый поток, редиректы не переходим —
+    # как и тестовый клиент
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect())
+
+    def _open(self, req):
+        try:
+            with self.opener.open(req, timeout=30) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+    def get(self, path):
+        return self._open(self.base_url + path)
+
+    def post(self, path, data):
+        body = urllib.parse.urlencode(data).encode()
+        return self._open(urllib.request.Request(self.base_url + path, data=body))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workers, threads, env):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app", "-b", f"127.0.0.1:{port}",
+         "-w", str(workers), "--threads", str(threads), "--chdir", BASE_DIR,
+         "--log-level", "warning"],
+        env=env)
+    base_url = f"http://127.0.0.1:{port}"
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise click.ClickException("gunicorn не запустился")
+        try:
+            urllib.request.urlopen(base_url + "/", timeout=1).read()
+            return proc, base_url
+        except OSError:
+            time.sleep(0.2)
+
+    proc.terminate()
+    raise click.ClickException("gunicorn не ответил за 30 секунд")
+
+
+# ================== SCENARIOS ==================
+
+def make_request(name, driver, username, rng, catalog):
+    code = rng.choice(catalog[username])
+    category = rng.choice(CATEGORIES)
+
+    if name == "login":
+        return driver.post("/", {"login": username, "password": PASSWORD})
+    if name == "sale_preview":
+        return driver.get(f"/worker/sale?code={code}")
+    if name == "sale":
+        return driver.post("/worker/sale", {"code": code, "quantity": "1"})
+    if name == "search":
+        word = rng.choice(ITEMS + COLORS)[:rng.randint(3, 6)]
+        return driver.get(f"/worker/{category}?search={urllib.parse.quote(word)}")
+    if name == "sales_history":
+        return driver.get("/worker/sales_history")
+    if name == "size_table":
+        return driver.get(f"/worker/{category}/table")
+    raise click.ClickException(f"неизвестный сценарий {name}")
+
+
+def percentile(values, p):
+    # nearest-rank по отсортированному списку
+    if not values:
+        return None
+    k = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[k]
+
+
+def run_scenario(name, drivers, catalog, requests, warmup, seed):
+    # каждый поток работает своим драйвером (своей сессией) и своим rng
+    per_thread = max(1, requests // len(drivers))
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(index):
+        nonlocal errors
+        driver, username = drivers[index]
+        rng = random.Random(f"{seed}:{name}:{index}")
+        local = []
+        bad = 0
+        for n in range(warmup + per_thread):
+            start = time.perf_counter()
+            status = make_request(name, driver, username, rng, catalog)
+            elapsed = time.perf_counter() - start
+            if n >= warmup:
+                local.append(elapsed)
+                if status >= 400:
+                    bad += 1
+        with lock:
+            latencies.extend(local)
+            errors += bad
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(drivers)) as pool:
+        list(pool.map(worker, range(len(drivers))))
+    # прогрев входит в общее время, поэтому пропускная способность считается по нему
+    wall = time.perf_counter() - wall_start
+    total = len(drivers) * (warmup + per_thread)
+
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "max_ms": ms(latencies[-1]) if latencies else None,
+        "rps": round(total / wall, 1) if wall else None,
+    }
+
+
+def run_target(make_driver, catalog, scenarios, requests, warmup, concurrency, seed):
+    usernames = sorted(catalog)
+    drivers = []
+    for i in range(concurrency):
+        driver = make_driver()
+        username = usernames[i % len(usernames)]
+        driver.post("/", {"login": username, "password": PASSWORD})
+        drivers.append((driver, username))
+
+    results = {}
+    for name in scenarios:
+        results[name] = run_scenario(name, drivers, catalog, requests, warmup, seed)
+        r = results[name]
+        click.echo(f"  {name:<14} p50 {r['p50_ms']:>8} ms  p95 {r['p95_ms']:>8} ms  "
+                   f"p99 {r['p99_ms']:>8} ms  {r['rps']:>8} req/s  errors {r['errors']}")
+    return results
+
+
+# ================== REPORT ==================
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+
+    click.echo(f"\nсравнение с {baseline_path} (изменение p50 / p95 / req/s):")
+    for target, scenarios in results.items():
+        for name, r in scenarios.items():
+            old = baseline.get(target, {}).get(name)
+            if not old:
+                continue
+            deltas = []
+            for key in ("p50_ms", "p95_ms", "rps"):
+                if old.get(key) and r.get(key) is not None:
+                    deltas.append(f"{(r[key] - old[key]) / old[key] * 100:+.1f}%")
+                else:
+                    deltas.append("—")
+            click.echo(f"  {target:<9} {name:<14} " + "  ".join(f"{d:>8}" for d in deltas))
+
+
+@click.command()
+@click.option("--target", type=click.Choice(["client", "gunicorn", "both"]), default="client")
+@click.option("--tenants", default=4, show_default=True, help="сколько работников создать")
+@click.option("--products", default=5000, show_default=True, help="товаров у каждого работника")
+@click.option("--sales", default=20000, show_default=True, help="продаж в истории каждого работника")
+@click.option("--requests", "requests_", default=500, show_default=True, help="запросов на сценарий")
+@click.option("--warmup", default=20, show_default=True, help="прогревочных запросов на поток")
+@click.option("--concurrency", default=4, show_default=True, help="параллельных сессий")
+@click.option("--workers", default=2, show_default=True, help="воркеров gunicorn")
+@click.option("--threads", default=1, show_default=True, help="потоков на воркер gunicorn (gthread при > 1)")
+@click.option("--storage", type=click.Choice(["files", "shared"]), default="files", show_default=True)
+@click.option("--group-commit", is_flag=True, help="продажи через групповой коммит (BRATEX_GROUP_COMMIT=1)")
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(SCENARIOS),
+              help="только эти сценарии (по умолчанию все)")
+@click.option("--seed", default=1, show_default=True)
+@click.option("--data-dir", type=click.Path(file_okay=False), help="папка для баз (по умолчанию временная)")
+@click.option("--out", type=click.Path(dir_okay=False), help="записать результаты в JSON")
+@click.option("--compare", "baseline", type=click.Path(exists=True, dir_okay=False),
+              help="JSON прошлого запуска для сравнения")
+def bench(target, tenants, products, sales, requests_, warmup, concurrency, workers, threads, storage,
+          group_commit, scenarios, seed, data_dir, out, baseline):
+    """Нагрузочный тест: логин, продажа, поиск, история, таблица размеров."""
+    scenarios = list(scenarios or SCENARIOS)
+    tmp_dir = None
+    if not data_dir:
+        data_dir = tmp_dir = tempfile.mkdtemp(prefix="bratex-bench-")
+
+    # окружение задаём до импорта app — пути к базам читаются при импорте
+    os.environ["BRATEX_DATA_DIR"] = os.path.abspath(data_dir)
+    os.environ["BRATEX_STORAGE"] = storage
+    os.environ["BRATEX_GROUP_COMMIT"] = "1" if group_commit else "0"
+    sys.path.insert(0, BASE_DIR)
+    import app as bratex
+
+    try:
+        click.echo(f"seed: {tenants} tenants x {products} products, {sales} sales ({data_dir})")
+        start = time.perf_counter()
+        catalog = seed_data(bratex, tenants, products, sales, seed)
+        seed_seconds = round(time.perf_counter() - start, 2)
+
+        results = {}
+        if target in ("client", "both"):
+            click.echo("client:")
+            results["client"] = run_target(lambda: ClientDriver(bratex), catalog, scenarios,
+                                           requests_, warmup, concurrency, seed)
+        if target in ("gunicorn", "both"):
+            # отдаём файлы баз gunicorn'у: свои соединения закрываем
+            for path in list(bratex._ready_dbs):
+                bratex.forget_db(path)
+            proc, base_url = start_gunicorn(workers, threads, dict(os.environ))
+            try:
+                click.echo(f"gunicorn ({workers} workers x {threads} threads):")
+                results["gunicorn"] = run_target(lambda: HttpDriver(base_url), catalog, scenarios,
+                                                 requests_, warmup, concurrency, seed)
+            finally:
+                proc.terminate()
+                proc.wait(timeout=10)
+
+        report = {
+            "meta": {
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+                "seed_seconds": seed_seconds,
+                "params": {
+                    "tenants": tenants, "products": products, "sales": sales,
+                    "requests": requests_, "warmup": warmup, "concurrency": concurrency,
+                    "workers": workers, "threads": threads, "storage": storage, "group_commit": group_commit,
+                    "seed": seed,
+                },
+            },
+            "results": results,
+        }
+
+        if out:
+            with open(out, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            click.echo(f"results: {out}")
+        if baseline:
+            compare(results, baseline)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    bench()